@@ -0,0 +1,212 @@
+import sys
+import json
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+from timeit import default_timer
+from twisted.internet import reactor
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.protocols.basic import LineReceiver
+from blockchain import Block, Transaction, BlockChain, BlockChainP2P, BlockChainFactory, GENESIS_TIMESTAMP, NULL_HASH, MAX_TARGET, TARGET_BLOCK_TIME
+from blockstore import BlockStore
+from credentials import CredentialStore
+
+
+SEED=0
+PARTICIPANTS=("Supplier", "CompanyA", "CompanyB", "CBDT", "Auditors")
+BLOCK_TYPES=("Sales", "Expenditure")
+
+
+class BenchmarkChain(BlockChain):
+    #starts at the easiest target and make_block spaces blocks at the goal, so retargeting keeps it there
+    #and the long chains below stay valid at a few hashes per block
+
+    def generateGenesisBlock(self):
+        return Block.fromTransactions(0, GENESIS_TIMESTAMP, [Transaction("Genesis Block", 'Genesis Block', '', '', 0)], NULL_HASH, MAX_TARGET)
+
+
+def make_block(rng, height, prevhash):
+    #deterministic block contents for a given seed and height, mined by the chain it is added to
+    to_address, from_address = rng.sample(PARTICIPANTS, 2)
+    timestamp=GENESIS_TIMESTAMP+height*int(TARGET_BLOCK_TIME*1000000)
+    tx=Transaction(rng.choice(BLOCK_TYPES), float(rng.randint(1, 1000)), to_address, from_address, rng.getrandbits(64))
+    return Block.fromTransactions(height, timestamp, [tx], prevhash)
+
+
+def build_chain(count, store=None, seed=SEED):
+    rng=random.Random(seed)
+    chain=BenchmarkChain(store)
+    for height in range(1, count):
+        chain.addNewBlock(make_block(rng, height, chain.getLastBlock().hash))
+    return chain
+
+
+def bench_mining(difficulties, blocks):
+    #hashes are counted from the nonce each search ends on, since mineBlock tries nonces in order
+    results=[]
+    for difficulty in difficulties:
+        rng=random.Random(SEED)
+        hashes, elapsed = 0, 0.0
+        for height in range(blocks):
+            block=make_block(rng, height+1, '\x00'*32)
+            start=block.nonce=0
+            started=default_timer()
+            block.mineBlock(difficulty)
+            elapsed+=default_timer()-started
+            hashes+=block.nonce-start+1
+        results.append({"benchmark": "mine", "difficulty": difficulty, "blocks": blocks, "hashes": hashes,
+                        "seconds": elapsed, "hashes_per_second": hashes/elapsed})
+    return results
+
+
+def bench_validation(sizes):
+    #each chain is written to a block store and reopened, so the first pass pays for decoding and indexing like a restarted node
+    results=[]
+    for size in sizes:
+        path=tempfile.mkdtemp(prefix="bench-chain-")
+        try:
+            store=BlockStore(path, fsync_batch=size)
+            build_chain(size, store)
+            store.close()
+            store=BlockStore(path)
+            chain=BenchmarkChain(store)
+            for name, run in (("get_total_transactions_cold", chain.get_total_transactions),
+                              ("isValid_full", lambda: chain.isValid(full=True)),
+                              ("get_total_transactions", chain.get_total_transactions)):
+                started=default_timer()
+                run()
+                elapsed=default_timer()-started
+                results.append({"benchmark": name, "blocks": size, "seconds": elapsed, "blocks_per_second": size/elapsed})
+            store.close()
+        finally:
+            shutil.rmtree(path)
+    return results
+
+
+def bench_update(user_counts, blocks, rounds):
+    #every user holds a view of the shared chain, one of them a block ahead, and `update` brings the rest up to it
+    results=[]
+    ledger=build_chain(blocks)
+    rng=random.Random(SEED)
+    for users in user_counts:
+        instances=dict(("user%d" % i, ledger.fork()) for i in range(users))
+        protocol=BlockChainP2P({}, instances, None, ledger)
+        elapsed=0.0
+        for update in range(rounds):
+            leader=instances["user%d" % rng.randrange(users)]
+            leader.addNewBlock(make_block(rng, leader.height, leader.getLastBlock().hash))
+            started=default_timer()
+            protocol.command_update(["update"])
+            elapsed+=default_timer()-started
+        results.append({"benchmark": "update", "users": users, "blocks": blocks, "rounds": rounds,
+                        "seconds": elapsed, "seconds_per_update": elapsed/rounds})
+    return results
+
+
+def bench_node(datadir, clients):
+    #a node with one account per simulated client, hashed with a single round so logins do not dominate the timings
+    credentials=CredentialStore(iterations=1)
+    for i in range(clients):
+        credentials.add("bench%d" % i, "bench%d" % i)
+    return BlockChainFactory(datadir, credentials=credentials, maxConnections=clients, maxConnectionsPerIP=clients)
+
+
+class BenchmarkClient(LineReceiver):
+    #logs in, pipelines all of its commands at once and fires `done` when the last reply has arrived
+
+    def __init__(self, name, command, count):
+        self.name=name
+        self.command=command
+        self.count=count
+        self.replies=0
+        self.done=defer.Deferred()
+
+    def connectionMade(self):
+        self.sendLine("%s %s" % (self.name, self.name))
+
+    def lineReceived(self, line):
+        if line.startswith("Welcome"):
+            self.transport.write((self.command + self.delimiter)*self.count)
+        elif "[*]Balance for" in line:  #replies are sent as one line with embedded newlines
+            self.replies+=1
+            if self.replies == self.count:
+                self.transport.loseConnection()
+                self.done.callback(self.replies)
+
+
+@defer.inlineCallbacks
+def bench_commands(path, client_counts, commands):
+    #end-to-end `balance` round trips over loopback against a node running in this process
+    results=[]
+    factory=bench_node(path, max(client_counts))
+    port=reactor.listenTCP(0, factory, interface="127.0.0.1")
+    try:
+        for clients in client_counts:
+            endpoint=TCP4ClientEndpoint(reactor, "127.0.0.1", port.getHost().port)
+            protocols=[BenchmarkClient("bench%d" % i, "balance", commands) for i in range(clients)]
+            started=default_timer()
+            for protocol in protocols:
+                yield connectProtocol(endpoint, protocol)
+            yield defer.gatherResults([protocol.done for protocol in protocols])
+            elapsed=default_timer()-started
+            results.append({"benchmark": "commands", "clients": clients, "commands": clients*commands,
+                            "seconds": elapsed, "commands_per_second": clients*commands/elapsed})
+            while factory.users:  #let the server drop the finished sessions before the next round logs in again
+                yield task.deferLater(reactor, 0.01, lambda: None)
+    finally:
+        yield port.stopListening()
+    defer.returnValue(results)
+
+
+def parse_list(value):
+    return [int(float(item)) for item in value.split(",") if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for mining, validation, sync and command throughput")
+    parser.add_argument("--difficulties", type=parse_list, default=[1, 2, 3, 4, 5], help="comma separated mining difficulties")
+    parser.add_argument("--mine-blocks", type=int, default=3, help="blocks mined at every difficulty")
+    parser.add_argument("--chain-sizes", type=parse_list, default=[10**3, 10**4, 10**5, 10**6], help="comma separated chain lengths to validate")
+    parser.add_argument("--users", type=parse_list, default=[1, 10, 100, 1000], help="comma separated user counts for update")
+    parser.add_argument("--update-blocks", type=int, default=1000, help="length of the chain the update users share")
+    parser.add_argument("--update-rounds", type=int, default=100, help="updates timed at every user count")
+    parser.add_argument("--clients", type=parse_list, default=[1, 10, 100], help="comma separated simulated client counts")
+    parser.add_argument("--commands", type=int, default=100, help="commands pipelined by every client")
+    parser.add_argument("--only", action="append", choices=["mine", "validate", "update", "commands"], help="run only the named benchmark, may be repeated")
+    parser.add_argument("--output", default=None, help="file to write the JSON results to instead of stdout")
+    args = parser.parse_args(argv)
+    selected=set(args.only or ["mine", "validate", "update", "commands"])
+
+    report={"python": platform.python_version(), "platform": platform.platform(), "seed": SEED, "results": []}
+    if "mine" in selected:
+        report["results"]+=bench_mining(args.difficulties, args.mine_blocks)
+    if "validate" in selected:
+        report["results"]+=bench_validation(args.chain_sizes)
+    if "update" in selected:
+        report["results"]+=bench_update(args.users, args.update_blocks, args.update_rounds)
+    if "commands" in selected:
+        def finished(result):
+            if isinstance(result, list):
+                report["results"]+=result
+            else:
+                result.printTraceback(sys.stderr)
+            reactor.stop()
+        path=tempfile.mkdtemp(prefix="bench-node-")
+        reactor.callWhenRunning(lambda: bench_commands(path, args.clients, args.commands).addBoth(finished))
+        reactor.run()
+        shutil.rmtree(path)  #the node's store is closed by its shutdown triggers, so it goes only after the reactor stops
+
+    output=json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
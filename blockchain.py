@@ -1,327 +1,1791 @@
 import hashlib
-import json
+import binascii
+import time
 from datetime import datetime
 import random
 import socket
 import select
 import sys
 import copy
-from twisted.internet.protocol import Factory
-from twisted.protocols.basic import LineReceiver
+import base64
+import argparse
+import struct
+import itertools
+import os
+import bisect
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver, Int32StringReceiver
+from twisted.protocols.policies import TimeoutMixin
 from twisted.internet import reactor
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.python import failure
+from twisted.internet.interfaces import IPullProducer
+from zope.interface import implementer
+from miner import ParallelMiner, search_range, target_for_difficulty, work_for_target, CHUNK_SIZE, NONCE
+from blockstore import BlockStore
+from metrics import Metrics
+from taxes import TaxEngine, adjustment_for, TAXES_FILE
+from snapshots import Snapshot, SNAPSHOT_FILE
+from credentials import CredentialStore
+from webapi import ApiResource, ApiSite
 
 
-blockname=''
-transval=0
-from_addr=''
-to_addr=''
+GENESIS_TIMESTAMP=1514764800000000 # 2018-01-01 UTC, fixed so every node and every restart agrees on block 0
+NULL_HASH='\x00'*32 # previous hash of the genesis block
+INITIAL_TARGET=target_for_difficulty(3) # target of the genesis block and of every block before the first retarget
+MAX_TARGET=target_for_difficulty(1) # easiest target retargeting can reach
+RETARGET_INTERVAL=100 # blocks between target adjustments
+TARGET_BLOCK_TIME=10.0 # seconds between blocks that retargeting steers towards
+MAX_RETARGET_FACTOR=4 # one adjustment moves the target by at most this factor either way
+MAX_FUTURE_DRIFT=300*1000000 # microseconds a block may be stamped ahead of the receiving node's clock
+HEADER=struct.Struct('>32s32sq32s') # previous hash, merkle root, timestamp, target; the nonce is appended by the miner
+RECORD=struct.Struct('>32s32sqQ32s') # stored block: hash, previous hash, timestamp, nonce, target, then the body
+FIELD_LENGTH=struct.Struct('>H')
+AMOUNT=struct.Struct('>d')
+FRAME=struct.Struct('>IB') # framed request: request id, opcode, then the payload
+RESPONSE=struct.Struct('>IBB') # framed response: request id, opcode, status, then the payload
+COUNT=struct.Struct('>H')
+LENGTH=struct.Struct('>I')
+HEIGHT=struct.Struct('>Q')
+RANGE=struct.Struct('>QH') # first height, number of blocks
+LOCATOR=struct.Struct('>Q32s') # height, block hash
+TIP=struct.Struct('>Q32s32s') # height, tip hash, cumulative work
+BALANCE=struct.Struct('>dd') # incoming, outgoing
+OP_TIP, OP_HEADERS, OP_BLOCKS, OP_BLOCK, OP_BALANCE, OP_TOTALS, OP_SUBMIT, OP_VERIFY, OP_BATCH = range(1, 10)
+STATUS_OK, STATUS_NOT_FOUND, STATUS_BAD_REQUEST, STATUS_REJECTED = range(4)
+DATA_DIR="blockchain_data"
+FSYNC_INTERVAL=1.0 # seconds between fsyncs of blocks appended since the last batch
+SYNC_BATCH=500 # headers or blocks sent per request between nodes
+MAX_FORK_DEPTH=1000 # side branches forking further below the tip are forgotten
+VIEW_PAGE_SIZE=50 # blocks rendered per write while streaming a view
+BLOCK_INTERVAL=1.0 # seconds an approved transaction waits for others to share its block
+MAX_BLOCK_TRANSACTIONS=1000 # a full template is mined right away
+MAX_BLOCK_BYTES=1000000
+PROPOSAL_TIMEOUT=300 # seconds a counterparty has to approve a proposed transaction
+SNAPSHOT_INTERVAL=1000 # blocks between ledger snapshots
+PRUNE_DEPTH=1000 # blocks below the tip kept decoded in memory, older ones are read back from the store
+MAX_CONNECTIONS=1000 # user interface connections, logged in or not
+MAX_CONNECTIONS_PER_IP=20
+LOGIN_TIMEOUT=30 # seconds to send the user name and password
+IDLE_TIMEOUT=900 # seconds a logged in session may stay silent
+CREDENTIALS_FILE="credentials"
+PARALLEL_VERIFY_MIN=5000 # below this many blocks a pool round trip costs more than hashing inline
+PARALLEL_VERIFY_BATCH=5000 # blocks decoded and hashed per pool round while verifying from the store
 
-class Block():
+def timestamp_now():
+    return int(time.time()*1000000)
 
-    def __init__(self,block_type,nonce,timestamp,transaction, to_address, from_address, prevhash=''):
-	self.block_type=block_type
-        self.nonce=nonce
-        self.timestamp=timestamp
-        self.transaction=transaction
+def format_timestamp(timestamp):
+    return str(datetime.fromtimestamp(timestamp//1000000).replace(microsecond=timestamp%1000000))
+
+def parse_timestamp(value):
+    #microseconds since the epoch as stored, or a local YYYY-MM-DD[THH:MM:SS] date as shown by view
+    if value.isdigit():
+        return int(value)
+    for layout in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(datetime.strptime(value, layout).timetuple()))*1000000
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+def pack_field(value):
+    return FIELD_LENGTH.pack(len(value)) + value
+
+def unpack_field(record, offset):
+    length=FIELD_LENGTH.unpack_from(record, offset)[0]
+    offset+=FIELD_LENGTH.size
+    return record[offset:offset+length], offset+length
+
+
+def merkle_root(leaves):
+    #pairwise sha256 up to a single digest, an odd last node is paired with itself
+    level=list(leaves) or [NULL_HASH]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level=[hashlib.sha256(level[i]+level[i+1]).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def retarget(target, first, last):
+    #scales a target by how long the last interval's blocks took against TARGET_BLOCK_TIME,
+    #by at most MAX_RETARGET_FACTOR either way and never easier than MAX_TARGET
+    expected=int((RETARGET_INTERVAL-1)*TARGET_BLOCK_TIME*1000000)
+    actual=max(expected//MAX_RETARGET_FACTOR, min(last-first, expected*MAX_RETARGET_FACTOR))
+    value=min(int(binascii.hexlify(target), 16)*actual//expected, int(binascii.hexlify(MAX_TARGET), 16))
+    return binascii.unhexlify('%064x' % value)
+
+
+def timestamp_allowed(timestamp, parent, now):
+    #block times must grow with height and stay near real time, or retargeting and time range queries could be gamed
+    return parent.timestamp < timestamp <= now+MAX_FUTURE_DRIFT
+
+
+def next_target(height, parent, timestamp_at):
+    #target the block at `height` must carry: its parent's, except every RETARGET_INTERVAL blocks where the
+    #timestamps of the last interval decide it; the first interval is skipped since the genesis time is fixed
+    if height <= RETARGET_INTERVAL or height % RETARGET_INTERVAL:
+        return parent.target
+    return retarget(parent.target, timestamp_at(height-RETARGET_INTERVAL), parent.timestamp)
+
+
+class Transaction(object):
+
+    __slots__=('block_type', 'amount', 'to_address', 'from_address', 'nonce')
+
+    def __init__(self, block_type, amount, to_address, from_address, nonce=None):
+        self.block_type=block_type
+        self.amount=amount
         self.to_address=to_address
         self.from_address=from_address
+        self.nonce=random.getrandbits(64) if nonce is None else nonce # two otherwise identical transactions never share a hash
+
+    def toBytes(self):
+        record=NONCE.pack(self.nonce) + pack_field(str(self.block_type)) + pack_field(str(self.to_address)) + pack_field(str(self.from_address))
+        if isinstance(self.amount, (int, float)):
+            return record + 'd' + AMOUNT.pack(self.amount)
+        return record + 's' + pack_field(str(self.amount))
+
+    @staticmethod
+    def fromBytes(record, offset=0):
+        tx=Transaction.__new__(Transaction)
+        tx.nonce=NONCE.unpack_from(record, offset)[0]
+        tx.block_type, offset = unpack_field(record, offset+NONCE.size)
+        tx.to_address, offset = unpack_field(record, offset)
+        tx.from_address, offset = unpack_field(record, offset)
+        if record[offset:offset+1] == 'd':
+            tx.amount=AMOUNT.unpack_from(record, offset+1)[0]
+            return tx, offset+1+AMOUNT.size
+        tx.amount, offset = unpack_field(record, offset+1)
+        return tx, offset
+
+    def calcHash(self):
+        return hashlib.sha256(self.toBytes()).digest()
+
+    def __str__(self):
+        return "%s of %s from %s to %s" % (self.block_type, self.amount, self.from_address, self.to_address)
+
+
+
+class Block(object):
+
+    #hashes are raw 32-byte sha256 digests and timestamps integer microseconds; __str__ renders them as before
+    #a block carries one or more transactions; the header commits to them through their merkle root
+    __slots__=('transactions', 'nonce', 'timestamp', 'prevhash', 'target', 'hash')
+
+    def __init__(self,block_type,nonce,timestamp,transaction, to_address, from_address, prevhash=NULL_HASH, target=INITIAL_TARGET):
+        self.transactions=[Transaction(block_type, transaction, to_address, from_address)]
+        self.nonce=nonce
+        self.timestamp=timestamp
         self.prevhash=prevhash
+        self.target=target
         self.hash=self.calcHash()
 
+    @staticmethod
+    def fromTransactions(nonce, timestamp, transactions, prevhash=NULL_HASH, target=INITIAL_TARGET):
+        block=Block.__new__(Block)
+        block.transactions=list(transactions)
+        block.nonce=nonce
+        block.timestamp=timestamp
+        block.prevhash=prevhash
+        block.target=target
+        block.hash=block.calcHash()
+        return block
+
+    #single transaction blocks read as before; a batch reports its type as "Batch" and its total value
+    @property
+    def block_type(self):
+        return self.transactions[0].block_type if len(self.transactions) == 1 else "Batch"
+
+    @property
+    def transaction(self):
+        if len(self.transactions) == 1:
+            return self.transactions[0].amount
+        return sum(tx.amount for tx in self.transactions)
+
+    @property
+    def to_address(self):
+        return self.transactions[0].to_address if len(self.transactions) == 1 else ''
+
+    @property
+    def from_address(self):
+        return self.transactions[0].from_address if len(self.transactions) == 1 else ''
+
+    def merkleRoot(self):
+        return merkle_root([tx.calcHash() for tx in self.transactions])
+
+    def hasDuplicateTransactions(self):
+        #an odd merkle level pairs its last node with itself, so a repeated last transaction leaves the block hash unchanged
+        leaves=[tx.calcHash() for tx in self.transactions]
+        return len(set(leaves)) != len(leaves)
+
+    def headerParts(self):
+        #fixed binary header, the nonce is packed after the prefix
+        return HEADER.pack(self.prevhash, self.merkleRoot(), self.timestamp, self.target), ''
+
+    def header(self):
+        prefix, suffix = self.headerParts()
+        return prefix + NONCE.pack(self.nonce) + suffix
+
     def calcHash(self):
-        block_string=json.dumps({"nonce":self.nonce, "timestamp":self.timestamp, "transaction":self.transaction, "prevhash":self.prevhash}, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        return hashlib.sha256(self.header()).digest()
 
-    def mineBlock(self,difficulty):
-        while(self.hash[:difficulty] != str('').zfill(difficulty)):  #check number of zeros in hash is equal to set difficulty value
-            self.nonce += 1
-            self.hash=self.calcHash()
+    def mineBlock(self,difficulty=None):
+        if difficulty is not None:  #a number of leading hex zeros replaces the block's own target
+            self.target=target_for_difficulty(difficulty)
+        prefix, suffix = self.headerParts()
+        nonce=None
+        while nonce is None:  #check the digest against the block's target
+            nonce=search_range((prefix, suffix, self.nonce, CHUNK_SIZE, self.target))
+            if nonce is None:
+                self.nonce += CHUNK_SIZE
+        self.nonce=nonce
+        self.hash=self.calcHash()
         #print("Mined Block:",self.hash)
 
     def __str__(self):
-	string="Block Type:\t" + str(self.block_type) + "\n"
+        string="Block Type:\t" + str(self.block_type) + "\n"
         string+="Nonce:\t" + str(self.nonce) + "\n"
-        string+="Timestamp:\t" + self.timestamp + "\n"
+        string+="Target:\t" + binascii.hexlify(self.target) + "\n"
+        string+="Timestamp:\t" + format_timestamp(self.timestamp) + "\n"
         string+="Transaction:\t" + str(self.transaction) + "\n"
-        string+="To Address:\t" + str(self.to_address) + "\n"
-        string+="From Address:\t" + str(self.from_address) + "\n"
-        string+="Previous Hash:\t" + self.prevhash + "\n"
-        string+="Current Hash:\t" + self.hash
+        if len(self.transactions) > 1:
+            for index, tx in enumerate(self.transactions):
+                string+="  #" + str(index) + ":\t" + str(tx) + "\n"
+        else:
+            string+="To Address:\t" + str(self.to_address) + "\n"
+            string+="From Address:\t" + str(self.from_address) + "\n"
+        string+="Previous Hash:\t" + (binascii.hexlify(self.prevhash) if self.prevhash != NULL_HASH else '') + "\n"
+        string+="Current Hash:\t" + binascii.hexlify(self.hash)
         return string
 
+    def toBytes(self):
+        return RECORD.pack(self.hash, self.prevhash, self.timestamp, self.nonce, self.target) + ''.join(tx.toBytes() for tx in self.transactions)
+
+    @staticmethod
+    def fromBytes(record):
+        #the stored hash is kept as is, so verify still catches a record that no longer matches it
+        block=Block.__new__(Block)
+        block.hash, block.prevhash, block.timestamp, block.nonce, block.target = RECORD.unpack_from(record)
+        block.transactions, offset = [], RECORD.size
+        while offset < len(record):
+            tx, offset = Transaction.fromBytes(record, offset)
+            block.transactions.append(tx)
+        return block
 
 
-class BlockChain():
+
+class LedgerIndex():
+    #running per-address and per-block-type totals, updated as blocks are appended
 
     def __init__(self):
-        self.chain=[self.generateGenesisBlock(),]
-        self.difficulty=3
+        self.addresses=[] # in order of first appearance, as listed by the transactions command
+        self.totals={} # address -> [incoming, outgoing, number of blocks touching it]
+        self.types={} # block type -> total transaction value
+
+    def copy(self):
+        index=LedgerIndex()
+        index.addresses=list(self.addresses)
+        index.totals=dict((addr, list(entry)) for addr, entry in self.totals.items())
+        index.types=dict(self.types)
+        return index
+
+    def entry(self, addr):
+        if addr not in self.totals:
+            self.totals[addr]=[0, 0, 0]
+            self.addresses.append(addr)
+        return self.totals[addr]
+
+    def apply(self, block):
+        for tx in block.transactions:
+            self.entry(tx.to_address)[0]+=tx.amount
+            self.entry(tx.to_address)[2]+=1
+            self.entry(tx.from_address)[1]-=tx.amount
+            self.entry(tx.from_address)[2]+=1
+            self.types[tx.block_type]=self.types.get(tx.block_type, 0)+tx.amount
+
+    def revert(self, block):
+        for tx in reversed(block.transactions):
+            for addr, column, value in ((tx.to_address, 0, tx.amount), (tx.from_address, 1, -tx.amount)):
+                entry=self.totals[addr]
+                entry[column]-=value
+                entry[2]-=1
+            for addr in set((tx.to_address, tx.from_address)):
+                if self.totals[addr][2] == 0:
+                    del self.totals[addr]
+                    self.addresses.remove(addr)
+            self.types[tx.block_type]-=tx.amount
+
+    def balance(self, addr):
+        entry=self.totals.get(addr, [0, 0, 0])
+        return entry[0], entry[1]
+
+    def snapshot(self, height, tiphash):
+        index=self.copy()
+        return Snapshot(height, tiphash, index.addresses, index.totals, index.types)
+
+    @staticmethod
+    def fromSnapshot(snapshot):
+        index=LedgerIndex()
+        index.addresses=list(snapshot.addresses)
+        index.totals=dict((addr, list(snapshot.totals[addr])) for addr in index.addresses)
+        index.types=dict(snapshot.types)
+        return index
+
+
+
+class BlockLookup():
+    #block hash, address and transaction type -> block heights, so queries never scan the chain
+    #heights are appended in increasing order, so a view shorter than the shared list just stops early
+
+    def __init__(self):
+        self.hashes={} # block hash -> height
+        self.addresses={} # address -> heights of the blocks with a transaction to or from it
+        self.types={} # transaction type -> heights of the blocks holding one
+        self.heights=[] # every indexed height, in step with timestamps
+        self.timestamps=[]
+
+    def keys(self, block):
+        addresses=set(addr for tx in block.transactions for addr in (tx.to_address, tx.from_address))
+        return ((self.addresses, addresses), (self.types, set(tx.block_type for tx in block.transactions)))
+
+    def apply(self, height, block):
+        self.hashes[block.hash]=height
+        for table, keys in self.keys(block):
+            for key in keys:
+                table.setdefault(key, []).append(height)
+        self.heights.append(height)
+        self.timestamps.append(block.timestamp)
+
+    def revert(self, height, block):
+        del self.hashes[block.hash]
+        for table, keys in self.keys(block):
+            for key in keys:
+                table[key].pop()
+                if not table[key]:
+                    del table[key]
+        self.heights.pop()
+        self.timestamps.pop()
+
+    def truncated(self, height):
+        lookup=BlockLookup()
+        lookup.hashes=dict((h, position) for h, position in self.hashes.items() if position < height)
+        for table, kept in ((self.addresses, lookup.addresses), (self.types, lookup.types)):
+            for key, heights in table.items():
+                end=bisect.bisect_left(heights, height)
+                if end:
+                    kept[key]=heights[:end]
+        end=bisect.bisect_left(self.heights, height)
+        lookup.heights, lookup.timestamps = self.heights[:end], self.timestamps[:end]
+        return lookup
+
+
+
+class BlockList():
+    #append-only block list that keeps a LedgerIndex over everything after the genesis block
+    #with a store, blocks already on disk start as None and are decoded the first time they are read
+
+    def __init__(self, blocks=(), store=None):
+        self.store=store
+        self.persist=store is not None
+        self.items=[None]*len(store) if store is not None else []
+        self.index=LedgerIndex()
+        self.lookup=BlockLookup()
+        self.indexed=min(len(self.items), 1) # blocks below this position are in the index
+        self.looked=self.indexed # blocks below this position are in the lookup
+        self.evicted=0 # blocks below this position are read from the store on every access instead of being kept
+        for block in blocks:
+            self.append(block)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.items)))]
+        if index < 0:
+            index+=len(self.items)
+        block=self.items[index]
+        if block is None:
+            block=Block.fromBytes(self.store.get(index))
+            if index >= self.evicted:
+                self.items[index]=block
+        return block
+
+    def __iter__(self):
+        for index in range(len(self.items)):
+            yield self[index]
+
+    def append(self, block):
+        self.items.append(block)
+        if self.persist:  #the store keeps cumulative work, counted from the block after genesis
+            self.store.append(block.toBytes(), work_for_target(block.target) if len(self.items) > 1 else 0)
+        if self.indexed == len(self.items)-1:
+            self.indexNext()
+        if self.looked == len(self.items)-1:
+            self.lookNext()
+
+    def indexNext(self):
+        if self.indexed:
+            self.index.apply(self[self.indexed])
+        self.indexed+=1
+
+    def lookNext(self):
+        if self.looked:
+            self.lookup.apply(self.looked, self[self.looked])
+        self.looked+=1
+
+    def lookups(self):
+        while self.looked < len(self.items):  #built on the first query, a node restored from a snapshot never needs it otherwise
+            self.lookNext()
+        return self.lookup
+
+    def indexAt(self, height):
+        #index over the first `height` blocks, derived by reverting only the suffix above it
+        while self.indexed < len(self.items):  #blocks loaded from the store are indexed on first use
+            self.indexNext()
+        if height == len(self.items):
+            return self.index
+        index=self.index.copy()
+        for position in range(len(self.items)-1, max(height, 1)-1, -1):
+            index.revert(self[position])
+        return index
+
+    def truncate(self, height):
+        #in place, for the owner of the list rolling back to a fork point
+        for position in range(max(self.indexed, self.looked)-1, max(height, 1)-1, -1):
+            block=self[position]
+            if position < self.indexed:
+                self.index.revert(block)
+            if position < self.looked:
+                self.lookup.revert(position, block)
+        self.indexed=min(self.indexed, height)
+        self.looked=min(self.looked, height)
+        self.evicted=min(self.evicted, height)
+        del self.items[height:]
+        if self.persist:
+            self.store.truncate(height)
+
+    def truncated(self, height):
+        #the copy still reads unloaded blocks from the store, but never writes to it
+        blocks=BlockList(store=self.store)
+        blocks.persist=False
+        blocks.items=self.items[:height]
+        blocks.index=self.indexAt(height).copy()
+        blocks.indexed=height
+        blocks.looked=min(self.looked, height)
+        blocks.lookup=self.lookup.truncated(blocks.looked)
+        blocks.evicted=min(self.evicted, height)
+        return blocks
+
+    def evict(self, height):
+        #forgets the decoded blocks below `height`, only for the list that owns the store, where every block is on disk
+        if not self.persist:
+            return
+        for position in range(self.evicted, min(height, len(self.items))):
+            self.items[position]=None
+        self.evicted=max(self.evicted, min(height, len(self.items)))
+
+    def restore(self, snapshot):
+        #starts the index from a snapshot of the first `snapshot.height` blocks instead of replaying them
+        self.index=LedgerIndex.fromSnapshot(snapshot)
+        self.indexed=snapshot.height
+
+
+
+class ChainView():
+    #read-only window over the first `height` entries of a shared block list
+
+    def __init__(self, blocks, height):
+        self.blocks=blocks
+        self.height=height
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.blocks[i] for i in range(*index.indices(self.height))]
+        if index < 0:
+            index+=self.height
+        if index < 0 or index >= self.height:
+            raise IndexError("chain index out of range")
+        return self.blocks[index]
+
+    def __iter__(self):
+        return itertools.islice(self.blocks, self.height)
+
+
+
+class BlockChain():
+
+    #blocks are never modified once appended, so chains share one append-only list and only
+    #keep their own height; forking is O(1) and the list is copied only when two forks diverge
+    def __init__(self, store=None):
+        if store is not None and len(store):  #resume from the stored tip without reading the blocks
+            if store.get(0) != self.generateGenesisBlock().toBytes():
+                raise ValueError("%s holds blocks of an incompatible format, remove it and resync" % store.path)
+            self.blocks=BlockList(store=store)
+        else:
+            self.blocks=BlockList([self.generateGenesisBlock(),], store=store)
+        self.height=len(self.blocks)
+        self.verified=1 # blocks below this height have already been checked
+        self.work=store.work(self.height-1) if store is not None else 0 # cumulative proof of work of every block after genesis
+
+    @property
+    def chain(self):
+        return ChainView(self.blocks, self.height)
+
+    def fork(self):
+        return copy.copy(self)
+
+    def syncFrom(self, other):
+        self.blocks=other.blocks
+        self.height=other.height
+        self.verified=other.verified
+        self.work=other.work
+
+    def extendFrom(self, other):
+        #a view sharing `other`'s storage one block behind only moves its tip up and keeps its own checkpoint, any other view resyncs
+        if self.blocks is other.blocks and self.height == other.height-1:
+            self.height=other.height
+            self.work=other.work
+        else:
+            self.syncFrom(other)
+
+    def appendBlock(self, block):
+        if self.height == len(self.blocks):
+            self.blocks.append(block)
+        elif self.blocks[self.height] is not block:  #another fork already extended the shared list, copy on write
+            self.blocks=self.blocks.truncated(self.height)
+            self.blocks.append(block)
+        self.height+=1
+        self.work+=self.blockWork(block)
+
+    def blockWork(self, block):
+        return work_for_target(block.target)
+
+    def nextTarget(self):
+        return next_target(self.height, self.getLastBlock(), lambda height: self.blocks[height].timestamp)
+
+    def workAt(self, height):
+        #cumulative work of the first `height` blocks, walking back only from the tip
+        work=self.work
+        for index in range(height, self.height):
+            work-=self.blockWork(self.blocks[index])
+        return work
+
+    def rollback(self, height):
+        #removes the blocks from `height` on and returns them; the storage is cut in place, so views sharing it must resync
+        removed=[self.blocks[index] for index in range(height, self.height)]
+        self.blocks.truncate(height)
+        self.height=height
+        self.verified=min(self.verified, height)
+        self.work-=sum(self.blockWork(block) for block in removed)
+        return removed
 
     def generateGenesisBlock(self):
-        return Block("Genesis Block",0,str(datetime.now()),'Genesis Block','','')
+        return Block.fromTransactions(0, GENESIS_TIMESTAMP, [Transaction("Genesis Block", 'Genesis Block', '', '', 0)])
 
     def getLastBlock(self):
         return self.chain[-1]
 
     def addNewBlock(self, newBlock):
         newBlock.prevhash=self.getLastBlock().hash
+        newBlock.timestamp=max(newBlock.timestamp, self.getLastBlock().timestamp+1)
+        newBlock.target=self.nextTarget()
         #newBlock.hash=newBlock.calcHash()
-        newBlock.mineBlock(self.difficulty)
-        self.chain.append(newBlock)
+        newBlock.mineBlock()
+        self.appendBlock(newBlock)
+
+    def mineNewBlock(self, newBlock, miner):
+        #same as addNewBlock, but the proof of work runs in the miner's process pool and a Deferred fires with the block
+        newBlock.prevhash=self.getLastBlock().hash
+        newBlock.timestamp=max(newBlock.timestamp, self.getLastBlock().timestamp+1)  #a parent stamped by a peer with a faster clock
+        newBlock.target=self.nextTarget()
+        d=miner.mine(newBlock)
+        def mined(block):
+            if block.prevhash != self.getLastBlock().hash:  #the tip moved while mining, mine again on top of it
+                return self.mineNewBlock(block, miner)
+            self.appendBlock(block)
+            return block
+        d.addCallback(mined)
+        return d
+
+    def appendMinedBlock(self, block):
+        #appends a block mined elsewhere by reference, after checking its header against this chain's tip
+        if block.prevhash != self.getLastBlock().hash:
+            return False
+        if not timestamp_allowed(block.timestamp, self.getLastBlock(), timestamp_now()):
+            return False
+        if block.target != self.nextTarget() or block.hash != block.calcHash() or block.hash > block.target:
+            return False
+        self.appendBlock(block)
+        return True
+
+    def isValid(self, full=False):
+        #only the blocks above the verified checkpoint are rehashed unless a full revalidation is asked for
+        start=1 if full else self.verified
+        return self.checkRange(self.blocks, start, self.height)
+
+    def isValidParallel(self, miner, full=False):
+        #same as isValid, but large ranges are read from the store and checked on a thread, with the headers
+        #hashed in the miner's process pool, and a Deferred fires with the result
+        blocks, start, end = self.blocks, 1 if full else self.verified, self.height
+        if end-start < PARALLEL_VERIFY_MIN or not blocks.persist:  #only the list owning the store has every block on disk
+            return defer.succeed(self.checkRange(blocks, start, end))
+        d=threads.deferToThread(self.checkStored, blocks.store, start, end, miner)
+        d.addCallback(self.storedChecked, blocks, end)
+        return d
+
+    def checkStored(self, store, start, end, miner):
+        #runs on a thread: decodes one batch at a time from the store's own handles, keeping only the
+        #blocks before it that the next batch's parent and retarget checks look back to
+        window, height = {}, max(start-RETARGET_INTERVAL-1, 0)
+        records=store.records(height, end)
+        for first in range(start, end, PARALLEL_VERIFY_BATCH):
+            last=min(first+PARALLEL_VERIFY_BATCH, end)
+            while height < last:
+                window[height]=Block.fromBytes(next(records))
+                height+=1
+            hashes=miner.hashHeaders([window[index].header() for index in range(first, last)])
+            string, valid = self.checkRange(window, first, last, hashes)
+            if not valid:
+                return string, valid
+            for index in [index for index in window if index < last-RETARGET_INTERVAL-1]:
+                del window[index]
+        return "BlockChain is Valid!!!\n", True
+
+    def storedChecked(self, result, blocks, end):
+        if result[1] and blocks is self.blocks:
+            self.verified=max(self.verified, end)
+        return result
 
-    def isValid(self):
+    def checkRange(self, blocks, start, end, hashes=None):
         string=''
-        for index in range(1,len(self.chain)):
-            prevb=self.chain[index-1]
-            currb=self.chain[index]
-            if(currb.hash != currb.calcHash()):
+        now=timestamp_now()
+        for index in range(start,end):
+            prevb=blocks[index-1]
+            currb=blocks[index]
+            if(currb.hash != (hashes[index-start] if hashes else currb.calcHash())):
                 string+="BlockChain Tampered :: Error in Computing Hash!!\n"
                 return string, False
             if(prevb.hash != currb.prevhash):
                 string+="BlockChain Tampered :: Error in Computing Hash!!\n"
                 return string, False
+            if(currb.target != next_target(index, prevb, lambda height: blocks[height].timestamp) or currb.hash > currb.target):
+                string+="BlockChain Tampered :: Error in Proof of Work!!\n"
+                return string, False
+            if not timestamp_allowed(currb.timestamp, prevb, now):
+                string+="BlockChain Tampered :: Error in Block Timestamp!!\n"
+                return string, False
+        if blocks is self.blocks:
+            self.verified=max(self.verified, end)
         string+="BlockChain is Valid!!!\n"
         return string, True
 
+    def getIndex(self):
+        return self.blocks.indexAt(self.height)
+
+    def getBalance(self, addr):
+        return self.getIndex().balance(addr)
+
     def get_total_transactions(self):
-        address_set=[]
-        for index in range(1,len(self.chain)):
-            if self.chain[index].to_address not in address_set:
-                address_set.append(self.chain[index].to_address)
-            if self.chain[index].from_address not in address_set:
-                address_set.append(self.chain[index].from_address)
-
-        incoming=0
-        outgoing=0
+        index=self.getIndex()
         string=''
-        for enum,addr in enumerate(address_set):
-            for index in range(1,len(self.chain)):
-                if addr == self.chain[index].to_address:
-                    incoming+= self.chain[index].transaction
-                if addr == self.chain[index].from_address:
-                    outgoing-= self.chain[index].transaction
-            string+="################ Net Transactions for {} #################\n".format(address_set[enum])
+        for addr in index.addresses:
+            incoming, outgoing = index.balance(addr)
+            string+="################ Net Transactions for {} #################\n".format(addr)
             string+="Incoming Transactions: {}\n".format(incoming)
             string+="Outgoing Transactions: {}\n".format(outgoing)
-            incoming=0
-            outgoing=0
+        if index.types:
+            string+="################ Totals by Block Type #################\n"
+            for block_type in sorted(index.types):
+                string+="{}: {}\n".format(block_type, index.types[block_type])
         return string
 
 
     def viewBlockchain(self):
-    	string=''
-        for index, block in enumerate(self.chain):
-            string+="#########################" + " Block " + str(index) + " #########################\n"
-            string+=block.__str__()+"\n"
-    	return string
+        return ''.join(self.iterBlockchain())
+
+    def iterBlockchain(self, start=0, end=None):
+        #renders blocks [start, end) one at a time, so callers can page through the chain without building it all
+        end=self.height if end is None else min(end, self.height)
+        for index in range(max(start, 0), end):
+            yield self.renderBlock(index)
+
+    def renderBlock(self, index):
+        return "#########################" + " Block " + str(index) + " #########################\n" + self.blocks[index].__str__() + "\n"
+
+    def findBlock(self, key):
+        #height of a block given its height or its hex hash, None when this chain does not hold it
+        if key.isdigit() and len(key) < 2*len(NULL_HASH):  #a hex hash can be all digits too
+            height=int(key)
+        else:
+            try:
+                blockhash=binascii.unhexlify(key)
+            except TypeError:
+                return None
+            height=0 if blockhash == self.blocks[0].hash else self.blocks.lookups().hashes.get(blockhash)
+        if height is None or height >= self.height:
+            return None
+        return height
+
+    def addressHistory(self, addr, limit):
+        #the latest `limit` blocks with a transaction to or from `addr`, oldest first
+        heights=self.blocks.lookups().addresses.get(addr, [])
+        end=bisect.bisect_left(heights, self.height)
+        return heights[max(end-limit, 0):end]
+
+    def heightsBetween(self, start, end, block_type=None):
+        #blocks stamped within [start, end]; validation keeps block times growing with height
+        lookup=self.blocks.lookups()
+        low=bisect.bisect_left(lookup.timestamps, start)
+        high=bisect.bisect_right(lookup.timestamps, end)
+        heights=lookup.heights[low:high]
+        if block_type is not None:
+            typed=lookup.types.get(block_type, [])
+            heights=typed[bisect.bisect_left(typed, heights[0]):bisect.bisect_right(typed, heights[-1])] if heights else []
+        return heights[:bisect.bisect_left(heights, self.height)]
 
     def lenBlockchain(self):
-	length=0
-	for index, block in enumerate(self.chain):
-	    length+=1
-	return length
+        return self.height
+
+    def snapshot(self, height):
+        return self.blocks.indexAt(height).snapshot(height, self.blocks[height-1].hash)
+
+    def restore(self, snapshot):
+        #a snapshot only applies to the chain whose block height-1 it was taken at, and vouches for every block below
+        if snapshot.height > self.height or snapshot.height <= self.blocks.indexed or self.blocks[snapshot.height-1].hash != snapshot.tiphash:
+            return False
+        self.blocks.restore(snapshot)
+        self.verified=max(self.verified, snapshot.height)
+        return True
+
+
+@implementer(IPullProducer)
+class BlockViewProducer():
+    #writes a view a page of blocks at a time, only when the transport asks for more
+
+    def __init__(self, protocol, pages):
+        self.protocol=protocol
+        self.pages=pages
+        self.command=protocol.command
+
+    def start(self):
+        self.protocol.transport.registerProducer(self, False)
 
+    def resumeProducing(self):
+        page=list(itertools.islice(self.pages, VIEW_PAGE_SIZE))
+        if page:
+            data=''.join(page)
+            self.protocol.factory.metrics.sent(self.command, len(data))
+            self.protocol.transport.write(data)
+            return
+        self.protocol.transport.unregisterProducer()
+        self.protocol.viewProducer=None
+        self.protocol.sendLine("")
 
-class BlockChainP2P(LineReceiver):
+    def stopProducing(self):
+        self.pages=iter(())
+        self.protocol.viewProducer=None
 
-    def __init__(self, users,instances):
+
+
+class BlockChainP2P(LineReceiver, TimeoutMixin):
+
+    def __init__(self, users,instances,miner,ledger):
 	#self.blockname=''
 	#self.to_addr=''
 	#self.transval=0
 	#self.from_addr=''
         self.instances= instances
         #self.instances[]={self.useself.blockchain=BlockChain()}
-        self.blockchain=BlockChain()
+        self.ledger=ledger
         self.users = users
+        self.miner = miner
+        self.viewProducer = None
         self.name = None
         self.state = "GETNAME"
-	self.allowed={"Supplier":"supplier","CompanyA":"compa", "CompanyB":"compb", "CBDT":"cbdt", "Auditors":"auditors"}
+        self.command = "login"
 
 
 
     def connectionMade(self):
+        self.factory.connectionOpened(self)
+        self.setTimeout(self.factory.loginTimeout)
         self.sendLine("[*]Enter \"help\" to list all the Available Commands")
         self.sendLine("[?]Enter UserName and Password")
 
     def connectionLost(self,reason):
-        if self.name in self.users:
+        self.setTimeout(None)
+        self.factory.connectionClosed(self)
+        if self.state == "CHAT" and self.users.get(self.name) is self:  #the next login forks the ledger again
             del self.users[self.name]
+            self.instances.pop(self.name, None)
+        self.state = "CLOSED"
+
+    def timeoutConnection(self):
+        self.sendLine("\n[!]Disconnected after Being Idle\n")
+        self.transport.loseConnection()
 
     def lineReceived(self, line):
+        self.resetTimeout()
         if self.state == "GETNAME":
             self.handle_GETNAME(line)
-        else:
+        elif self.state == "CHAT":
             self.handle_CHAT(line)
 
     def handle_GETNAME(self, name):
-	arguments = name.split(" ")
-	if(len(arguments)!=2):
-	    sendLine("Format for Entering is [Username] [Password]")
-	    self.transport.loseConnection()
+        arguments = name.split(" ")
+        if len(arguments)!=2:
+            self.sendLine("Format for Entering is [Username] [Password]")
+            self.transport.loseConnection()
+            return
+        self.state = "CHECKING"  #lines sent while the password is being checked are dropped
+        d = self.factory.credentials.check(arguments[0], arguments[1])
+        d.addCallback(self.loginChecked, arguments[0])
 
-	if arguments[0] in self.allowed and self.allowed[arguments[0]] == arguments[1] and arguments[0] not in self.users:
-	    self.sendLine("Welcome, %s!" % (arguments[0]))
-	    name=arguments[0]
-	    self.name=name
-	    self.users[name]=self
-	    self.instances[name]=copy.deepcopy(self.blockchain)
-            self.state = "CHAT"
+    def loginChecked(self, valid, name):
+        if self.state != "CHECKING":  #gone while the password was being checked
+            return
+        if not valid or name in self.users:
+            self.sendLine("Invalid Username and Password!!!")
+            self.transport.loseConnection()
+            return
+        self.sendLine("Welcome, %s!" % (name))
+        self.name=name
+        self.users[name]=self
+        self.instances[name]=self.ledger.fork()
+        self.state = "CHAT"
+        self.setTimeout(self.factory.idleTimeout)
 
-	else:
-	    self.sendLine("Invalid Username and Password!!!")
-	    if arguments[0] in self.users:
-		del self.users[self.name]
-	    self.transport.loseConnection()
+    def handle_CHAT(self, message):
+        #commands are looked up as command_<name> methods and reply straight to this connection
+        arguments = message.split(" ")
+        handler = getattr(self, "command_" + arguments[0], None)
+        self.command = arguments[0] if handler is not None else "unknown"
+        started = time.time()
+        message = handler(arguments) if handler is not None else "\n[!]Command Does Not Exist\n"
+        self.factory.metrics.record(self.command, time.time()-started)
+        if message is not None:
+            self.sendLine("%s\n" % (message))
 
+    def sendLine(self, line):
+        #counted against the command that was dispatched last on this connection
+        self.factory.metrics.sent(self.command, len(line)+len(self.delimiter))
+        LineReceiver.sendLine(self, line)
 
+    def command_exit(self, arguments):
+        self.transport.loseConnection()
 
+    def command_help(self, arguments):
+        message = "\n[*]Available Commands\n\n"
+        message += "exit: Disconnects from the server\n\n"
+        message += "verify [full]: Checks the validity of the blocks added since the last check, or of the entire blockchain\n\n"
+        message += "view [<from block> <to block> | tail <number of blocks>]: Shows the entire blockchain or a range of its blocks\n\n"
+        message += "block <hash|height>: Shows a single block\n\n"
+        message += "history <address> [limit]: Lists the transactions of an address in its latest blocks\n\n"
+        message += "range <from time> <to time> [transaction type]: Lists the blocks stamped in a period, times as YYYY-MM-DD[THH:MM:SS] or microseconds\n\n"
+        message += "transactions: Lists all the Incoming and Outgoing Transactions for each Participant\n\n"
+        message += "balance [address]: Shows the Incoming, Outgoing and Net Transactions of an address (default: your own)\n\n"
+        message += "list: Lists all the current online users\n\n"
+        message += "add <block type> <to address> <transaction quantity>: Proposes a Sales or Expenditure transaction to another participant\n\n"
+        message += "checked [proposal id]: Approves a transaction proposed to you, which is then added to the blockchain\n\n"
+        message += "update: Checks for all the local bloackchain Instances of the Users and Updates all the chains with the latest chain\n\n"
+        message += "adjust [<from block> <to block>]: Settles the CBDT adjustment of every company over the blocks since the last settlement, or over a range, in one batch\n\n"
+        message += "tax [company] [<from block> <to block>]: Shows the Sales and Expenditure totals of a company and the adjustment due on them\n\n"
+        message += "stats [json]: Shows per-command call counts, latencies and bytes sent, and the time spent mining and on the reactor\n\n"
+        return message
 
-    def handle_CHAT(self, message):
-        arguments = message.split(" ")
-    	if arguments[0] == "exit":
-    		if self.name in self.users:
-    			del self.users[self.name]
-    		self.transport.loseConnection()
-
-        elif arguments[0] == "help":
-            message = "\n[*]Available Commands\n\n"
-            message += "exit: Disconnects from the server\n\n"
-            message += "verify: Checks the validity of the blockchain\n\n"
-            message += "view: Shows the entire blockchain\n\n"
-            message += "transactions: Lists all the Incoming and Outgoing Transactions for each Participant\n\n"
-            message += "list: Lists all the current online users\n\n"
-            message += "add <from address> <to address> <transaction quantity>: Mines a new block which is added to the blockchain\n\n"
-            message += "update: Checks for all the local bloackchain Instances of the Users and Updates all the chains with the latest chain\n\n"
-	    message += "adjust: Checks between the Value difference between Sales Block and Expenditure Block and sends the corresponding tax value to CBDT\n\n"
-
-    	elif arguments[0] == "verify":
-		message = "\n[*]Verifying Blockchain Hash\n"
-		string,switch = self.instances[self.name].isValid()
-    		#string,switch=self.blockchain.isValid()
-    		message+=string
-
-    	elif arguments[0] == "view":
-    		message= "\n[*]Retrieving Blockchain\n"
-    		#message+=self.blockchain.viewBlockchain()
-		message += self.instances[self.name].viewBlockchain()
-
-    	elif arguments[0] == "transactions":
-    		message = "\n[*]Listing all Transactions on Blockchain\n"
-    		message += self.instances[self.name].get_total_transactions()
-
-    	elif arguments[0] == "list":
-    		message = "\n[*]Listing Online Users\n"
-    		for user in self.users:
-			user_arg=user.split(" ")
-    			message += "\n" + user_arg[0]
-
-    	elif arguments[0] == "add":
-            if len(arguments)<4:
-                message="Command Format :: add <block type> <to address> <transaction quantity>:"
-            elif len(arguments)==4 and (arguments[1]=="Sales" or arguments[1]=="Expenditure"):
-		global blockname
-		blockname = arguments[1]
-		global from_addr
-		from_addr = self.name
-		global to_addr
-		to_addr = arguments[2]
-		global transval
-		transval = arguments[3]
-		msg=''
-                msg = "Please Verify the Transaction!!!\n"
-                msg += "Block Type: " + str(blockname) + "\n"
-                msg += "From Address: " +str(from_addr) + "\n"
-                msg += "To Address: " + str(to_addr) + "\n"
-                msg += "Transaction Value: " + str(transval)+"\n"
-		message="[!!] Waiting for Apprroval from the Other Party!!"
-                for name, protocol in self.users.iteritems():
-                        if name == arguments[2]:
-                                protocol.sendLine(msg)
-
-	    else:
-		message="\n[!] Error in command!! Only \"Sales\" and \"Expenditure\" Blocks are Valid!!\n"
-
-		#message = "\n[*]Adding New Block for Transaction\n"
-		#for name in self.instances.keys():
-			#self.blockchain.addNewBlock(Block(random.randint(1,1001),str(datetime.now()),int(arguments[3]),arguments[1],arguments[2]))
-		#	self.instances[name].addNewBlock(Block(random.randint(1,1001),str(datetime.now()),int(arguments[3]),arguments[1],arguments[2]))
-    		#self.blockchain.addNewBlock(Block(random.randint(1,1001),str(datetime.now()),50,'Addr1','Addr2'))
-
-	elif arguments[0] == "checked":
-	    message = "\n[*]Adding New Block for Transaction\n"
-#	    global blockname
-#	    global transval
-#	    global from_addr
-#	    global to_addr
-#	    print(blockname)
-#	    print(transval)
-#	    print(from_addr)
-#	    print(to_addr)
-	    for nm in self.instances.keys():
-	        self.instances[nm].addNewBlock(Block(blockname,random.randint(1,1001),str(datetime.now()),float(transval),str(from_addr),str(to_addr)))
-
-	elif arguments[0] == "update":
-	    maxval=0
-	    final=''
-	    for name in self.instances.keys():
-	        if self.instances[name].lenBlockchain()>maxval:
-		    final=name
-		    maxval=self.instances[name].lenBlockchain()
-	    for name in self.instances.keys():
-	        if name!=final:
-		    self.instances[name]=copy.deepcopy(self.instances[final])
-	    message="\n[*]The entire Blockchain has been Updated!!\n"
-
-
-	elif arguments[0] == "adjust":
-	    expenditure=0
-	    profit=0
-            sales=0
-	    flag=0
-	    if self.instances[self.name].chain[-2].block_type=="Expenditure":
-		expenditure=self.instances[self.name].chain[-2].transaction
-		sales=self.instances[self.name].chain[-1].transaction
-		flag=1
-	    elif self.instances[self.name].chain[-1].block_type=="Expenditure":
-		expenditure=self.instances[self.name].chain[-1].transaction
-		sales=self.instances[self.name].chain[-2].transaction
-		flag=1
-	    else:
-		message="\n[!]The ordering of the Blocks should have Expenditure->Sales or Sales->Expenditure\n"
-	    if flag==1:
-	        profit=sales-expenditure
-	        threshold=float(14.5*expenditure)/float(100)
-#	        print(profit)
-#	        print(threshold)
-#	        print(sales)
-#	        print(expenditure)
-	        if profit > threshold:
-		    message="\n[*]No Adjustment Required!!\n"
-	        else:
-		    transval=(threshold-profit)*0.25
-		    for nm in self.instances.keys():
-                        self.instances[nm].addNewBlock(Block("Adjustment",random.randint(1,1001),str(datetime.now()),float(transval),"Company","CBDT"))
-
-
-    	else:
-    		message = "\n[!]Command Does Not Exist\n"
-
-
-        message = "%s\n" % (message)
-        for name, protocol in self.users.iteritems():
-            if protocol == self:
-                protocol.sendLine(message)
+    def command_verify(self, arguments):
+        #string,switch=self.blockchain.isValid()
+        self.sendLine("\n[*]Verifying Blockchain Hash")
+        full = len(arguments)>1 and arguments[1]=="full"
+        started = time.time()
+        d=self.instances[self.name].isValidParallel(self.miner, full=full)  #a chain reloaded from disk has no checkpoint yet
+        d.addCallback(lambda result: self.factory.metrics.timed("verifying", time.time()-started) or result)
+        d.addCallback(lambda result: self.sendLine(result[0]))
 
+    def command_view(self, arguments):
+        chain = self.instances[self.name]
+        try:
+            if len(arguments) == 1:
+                start, end = 0, chain.height
+            elif len(arguments) == 3 and arguments[1] == "tail":
+                start, end = chain.height-int(arguments[2]), chain.height
+            elif len(arguments) == 3:
+                start, end = int(arguments[1]), int(arguments[2])+1
+            else:
+                raise ValueError(arguments)
+        except ValueError:
+            return "Command Format :: view [<from block> <to block> | tail <number of blocks>]"
+        #message+=self.blockchain.viewBlockchain()
+        return self.stream("\n[*]Retrieving Blockchain", chain.iterBlockchain(start, end))
 
-class BlockChainFactory(Factory):
+    def stream(self, header, pages):
+        if self.viewProducer is not None:
+            return "\n[!]A View is Already Being Sent, Wait for it to Finish\n"
+        self.sendLine(header)
+        self.viewProducer = BlockViewProducer(self, pages)
+        self.viewProducer.start()
+
+    def command_block(self, arguments):
+        if len(arguments) != 2:
+            return "Command Format :: block <hash|height>"
+        chain = self.instances[self.name]
+        height = chain.findBlock(arguments[1])
+        if height is None:
+            return "\n[!]No Such Block on the Blockchain\n"
+        return "\n" + chain.renderBlock(height)
+
+    def command_history(self, arguments):
+        try:
+            limit = int(arguments[2]) if len(arguments)>2 else VIEW_PAGE_SIZE
+        except ValueError:
+            limit = -1
+        if len(arguments) not in (2, 3) or limit < 0:
+            return "Command Format :: history <address> [limit]"
+        chain, addr = self.instances[self.name], arguments[1]
+        heights = chain.addressHistory(addr, limit)
+        def lines():
+            for height in heights:
+                block = chain.blocks[height]
+                for tx in block.transactions:
+                    if addr in (tx.to_address, tx.from_address):
+                        yield "Block %d\t%s\t%s\n" % (height, format_timestamp(block.timestamp), tx)
+        return self.stream("\n[*]Last %d Blocks for %s" % (len(heights), addr), lines())
+
+    def command_range(self, arguments):
+        try:
+            start, end = parse_timestamp(arguments[1]), parse_timestamp(arguments[2])
+        except (ValueError, IndexError):
+            return "Command Format :: range <from time> <to time> [transaction type], times as YYYY-MM-DD[THH:MM:SS] or microseconds"
+        chain = self.instances[self.name]
+        heights = chain.heightsBetween(start, end, arguments[3] if len(arguments)>3 else None)
+        def lines():
+            for height in heights:
+                block = chain.blocks[height]
+                yield "Block %d\t%s\t%s\t%s\t%d transactions\n" % (height, format_timestamp(block.timestamp), binascii.hexlify(block.hash), block.block_type, len(block.transactions))
+        return self.stream("\n[*]%d Blocks in Range" % (len(heights)), lines())
+
+    def command_transactions(self, arguments):
+        message = "\n[*]Listing all Transactions on Blockchain\n"
+        message += self.instances[self.name].get_total_transactions()
+        return message
+
+    def command_balance(self, arguments):
+        addr = arguments[1] if len(arguments)>1 else self.name
+        incoming, outgoing = self.instances[self.name].getBalance(addr)
+        message = "\n[*]Balance for %s\n" % (addr)
+        message += "Incoming Transactions: {}\n".format(incoming)
+        message += "Outgoing Transactions: {}\n".format(outgoing)
+        message += "Net Balance: {}\n".format(incoming+outgoing)
+        return message
+
+    def command_list(self, arguments):
+        message = "\n[*]Listing Online Users\n"
+        for user in self.users:
+            user_arg=user.split(" ")
+            message += "\n" + user_arg[0]
+        return message
+
+    def command_add(self, arguments):
+        if len(arguments)<4:
+            return "Command Format :: add <block type> <to address> <transaction quantity>:"
+        if len(arguments)!=4 or (arguments[1]!="Sales" and arguments[1]!="Expenditure"):
+            return "\n[!] Error in command!! Only \"Sales\" and \"Expenditure\" Blocks are Valid!!\n"
+        try:
+            proposal = self.factory.proposals.propose(arguments[1], self.name, arguments[2], float(arguments[3]))
+        except ValueError:
+            return "\n[!] Error in command!! The Transaction Quantity must be a Number!!\n"
+        msg = "Please Verify the Transaction!!!\n"
+        msg += "Proposal ID: " + str(proposal.id) + "\n"
+        msg += "Block Type: " + str(proposal.block_type) + "\n"
+        msg += "From Address: " + str(proposal.proposer) + "\n"
+        msg += "To Address: " + str(proposal.counterparty) + "\n"
+        msg += "Transaction Value: " + str(proposal.amount) + "\n"
+        msg += "Enter \"checked " + str(proposal.id) + "\" to Approve\n"
+        if proposal.counterparty in self.users:
+            self.users[proposal.counterparty].sendLine(msg)
+        return "[!!] Waiting for Approval from the Other Party!! Proposal ID: " + str(proposal.id)
+
+    def command_checked(self, arguments):
+        pending = self.factory.proposals.pendingFor(self.name)
+        if len(arguments)>1:
+            try:
+                proposal = self.factory.proposals.approve(int(arguments[1]), self.name)
+            except ValueError:
+                proposal = None
+        elif len(pending)==1:  #a single pending proposal can be approved without its id
+            proposal = self.factory.proposals.approve(pending[0].id, self.name)
+        else:
+            proposal = None
+        if proposal is None:
+            message = "\n[!]No Matching Proposal, Enter \"checked <proposal id>\" for one of:\n"
+            for entry in pending:
+                message += "%d: %s of %s from %s\n" % (entry.id, entry.block_type, entry.amount, entry.proposer)
+            return message
+        self.submit(Transaction(proposal.block_type,proposal.amount,str(proposal.proposer),str(proposal.counterparty)))
+        if proposal.proposer in self.users:
+            self.users[proposal.proposer].sendLine("\n[*]Proposal " + str(proposal.id) + " was Approved by " + self.name + "\n")
+        return "\n[*]Transaction Queued for the Next Block\n"
+
+    def command_update(self, arguments):
+        #the chain with the most cumulative work wins, not the one with the most blocks
+        maxval=-1
+        final=''
+        for name in self.instances.keys():
+            if self.instances[name].work>maxval:
+                final=name
+                maxval=self.instances[name].work
+        for name in self.instances.keys():
+            if name!=final:
+                self.instances[name].syncFrom(self.instances[final])
+        return "\n[*]The entire Blockchain has been Updated!!\n"
+
+    def command_adjust(self, arguments):
+        #settles every company over a block range in one batch, by default everything since the last settled range
+        try:
+            start, end = (int(arguments[1]), int(arguments[2])+1) if len(arguments)==3 else (None, None)
+        except ValueError:
+            return "Command Format :: adjust [<from block> <to block>]"
+        if len(arguments) not in (1, 3):
+            return "Command Format :: adjust [<from block> <to block>]"
+        if self.factory.settling:  #the default range only moves on once the pending Adjustment block is mined
+            return "\n[!]A Tax Settlement is Still Waiting to be Mined!!\n"
+        self.factory.settling = True
+        d=self.factory.taxes.settlement(start, end)
+        d.addCallback(self.settle, start is None)
+        d.addErrback(self.settleFailed)
+
+    def settle(self, settlement, default):
+        start, end, rows = settlement
+        message = "\n[*]Tax Settlement for Blocks %d to %d\n" % (start, end-1)
+        adjustments = []
+        for company, sales, expenditure, adjustment in rows:
+            message += "%s :: Sales: %s Expenditure: %s Adjustment: %s\n" % (company, sales, expenditure, adjustment)
+            if adjustment > 0:
+                adjustments.append(Transaction("Adjustment",float(adjustment),str(company),"CBDT"))
+        if not adjustments:
+            self.factory.settling = False
+            self.sendLine(message + "[*]No Adjustment Required!!\n")
+            return
+        if default:  #the default range moves on once one of these is mined
+            self.factory.taxes.expect([tx.calcHash() for tx in adjustments], end)
+        #queued in one go, so the whole settlement is mined as one batch
+        d=defer.gatherResults([self.factory.submitTransaction(tx) for tx in adjustments], consumeErrors=True)
+        d.addCallbacks(lambda blocks: self.blockMined(blocks[0]), self.miningFailed)
+        d.addBoth(self.settleDone)
+        self.sendLine(message + "[*]Adjustments for CBDT Queued for the Next Block\n")
+
+    def settleDone(self, result):
+        self.factory.settling = False
+
+    def settleFailed(self, failure):
+        self.factory.settling = False
+        self.sendLine("\n[!]Tax Settlement Failed!!\n")
+
+    def command_tax(self, arguments):
+        try:
+            company = arguments[1] if len(arguments)>1 else self.name
+            start, end = (int(arguments[2]), int(arguments[3])+1) if len(arguments)==4 else (0, None)
+        except ValueError:
+            return "Command Format :: tax [company] [<from block> <to block>]"
+        d=self.factory.taxes.totals(company, start, end)
+        def report(totals):
+            sales, expenditure = totals
+            message = "\n[*]Tax Position for %s\n" % (company)
+            message += "Sales: {}\n".format(sales)
+            message += "Expenditure: {}\n".format(expenditure)
+            message += "Adjustment Due: {}\n".format(adjustment_for(sales, expenditure))
+            self.sendLine(message)
+        d.addCallback(report)
+
+    def command_stats(self, arguments):
+        if len(arguments)>1 and arguments[1]=="json":
+            return self.factory.metrics.toJSON()
+        return "\n[*]Server Statistics\n" + self.factory.metrics.summary()
+
+    def submit(self, tx):
+        d=self.factory.submitTransaction(tx)
+        d.addCallbacks(self.blockMined, self.miningFailed)
+        return d
+
+    def blockMined(self, block):
+        self.sendLine("\n[*]New Block Mined and Added to the Blockchain!!\n")
+
+    def miningFailed(self, failure):
+        self.sendLine("\n[!]Mining Failed for the New Block!!\n")
+
+
+class Proposal():
+
+    def __init__(self, proposal_id, block_type, proposer, counterparty, amount):
+        self.id=proposal_id
+        self.block_type=block_type
+        self.proposer=proposer
+        self.counterparty=counterparty
+        self.amount=amount
+        self.timer=None
+
+
+
+class ProposalTable():
+    #transactions waiting for the counterparty's approval, one per proposer/counterparty pair
+
+    def __init__(self, onExpire, onSupersede, timeout=PROPOSAL_TIMEOUT):
+        self.onExpire=onExpire
+        self.onSupersede=onSupersede
+        self.timeout=timeout
+        self.proposals={} # proposal id -> Proposal
+        self.pairs={} # (proposer, counterparty) -> proposal id
+        self.nextId=1
+
+    def propose(self, block_type, proposer, counterparty, amount):
+        #a newer proposal between the same pair replaces the pending one, and both parties are told
+        replaced=self.proposals[self.pairs[(proposer, counterparty)]] if (proposer, counterparty) in self.pairs else None
+        if replaced is not None:
+            self.remove(replaced)
+        proposal=Proposal(self.nextId, block_type, proposer, counterparty, amount)
+        self.nextId+=1
+        self.proposals[proposal.id]=proposal
+        self.pairs[(proposer, counterparty)]=proposal.id
+        proposal.timer=reactor.callLater(self.timeout, self.expire, proposal)
+        if replaced is not None:
+            self.onSupersede(replaced, proposal)
+        return proposal
+
+    def remove(self, proposal):
+        del self.proposals[proposal.id]
+        del self.pairs[(proposal.proposer, proposal.counterparty)]
+        if proposal.timer.active():
+            proposal.timer.cancel()
+
+    def approve(self, proposal_id, approver):
+        proposal=self.proposals.get(proposal_id)
+        if proposal is None or proposal.counterparty != approver:
+            return None
+        self.remove(proposal)
+        return proposal
+
+    def expire(self, proposal):
+        self.remove(proposal)
+        self.onExpire(proposal)
+
+    def pendingFor(self, counterparty):
+        return sorted((p for p in self.proposals.values() if p.counterparty == counterparty), key=lambda p: p.id)
+
+
+
+class Mempool():
+    #approved transactions waiting for a block, in arrival order
 
     def __init__(self):
+        self.pending=[] # (transaction, Deferred fired with the block that includes it, or None)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, tx, d=None):
+        self.pending.append((tx, d))
+
+    def template(self, max_transactions, max_bytes):
+        #takes the oldest transactions that fit in one block out of the pool
+        count, size = 0, 0
+        while count < len(self.pending) and count < max_transactions:
+            size+=len(self.pending[count][0].toBytes())
+            if count and size > max_bytes:
+                break
+            count+=1
+        entries, self.pending = self.pending[:count], self.pending[count:]
+        return entries
+
+
+
+class TreeNode():
+
+    def __init__(self, blockhash, prevhash, height, work, timestamp, target):
+        self.hash=blockhash
+        self.prevhash=prevhash
+        self.height=height
+        self.timestamp=timestamp
+        self.target=target
+        self.work=work # cumulative work up to and including this block
+        self.block=None # filled in once the full block has been fetched
+
+
+
+class ForkChoice():
+    #headers and blocks that are not on the ledger's active chain, indexed by hash, so competing
+    #branches can coexist; the ledger follows whichever fully downloaded branch has the most work
+
+    def __init__(self, node):
+        self.node=node
+        self.ledger=node.ledger
+        self.tree={}
+
+    def onActiveChain(self, blockhash, height):
+        return 0 <= height < self.ledger.height and self.ledger.chain[height].hash == blockhash
+
+    def parentWork(self, prevhash, height):
+        if self.onActiveChain(prevhash, height-1):
+            return self.ledger.workAt(height)
+        if prevhash in self.tree and self.tree[prevhash].height == height-1:
+            return self.tree[prevhash].work
+        return None
+
+    def branchBlock(self, blockhash, height, wanted):
+        #block or header at height `wanted` on the branch ending in `blockhash` at `height`
+        while not self.onActiveChain(blockhash, height):
+            node=self.tree[blockhash]
+            if height == wanted:
+                return node
+            blockhash, height = node.prevhash, height-1
+        return self.ledger.chain[wanted]
+
+    def addHeader(self, height, header):
+        #checks linkage, timestamp, the target the branch calls for and proof of work from the header alone, before the block is downloaded
+        blockhash=hashlib.sha256(header).digest()
+        if blockhash in self.tree:
+            return self.tree[blockhash]
+        prevhash, root, timestamp, target = HEADER.unpack_from(header)
+        if self.onActiveChain(blockhash, height) or blockhash > target:
+            return None
+        work=self.parentWork(prevhash, height)
+        if work is None:
+            return None
+        try:
+            parent=self.branchBlock(prevhash, height-1, height-1)
+            if not timestamp_allowed(timestamp, parent, timestamp_now()):
+                return None
+            if target != next_target(height, parent, lambda wanted: self.branchBlock(prevhash, height-1, wanted).timestamp):
+                return None
+        except KeyError:  #the branch reaches below headers already forgotten
+            return None
+        node=TreeNode(blockhash, prevhash, height, work+work_for_target(target), timestamp, target)
+        self.tree[blockhash]=node
+        return node
+
+    def addBlock(self, height, block):
+        if block.calcHash() != block.hash or block.hasDuplicateTransactions():
+            return None
+        node=self.addHeader(height, block.header())
+        if node is not None:
+            node.block=block
+            self.choose(node)
+        return node
+
+    def missing(self, node):
+        #nodes on the branch ending in `node` whose blocks are not downloaded yet, lowest first
+        missing=[]
+        while node is not None:
+            if node.block is None:
+                missing.append(node)
+            if self.onActiveChain(node.prevhash, node.height-1):
+                break
+            node=self.tree.get(node.prevhash)
+        missing.reverse()
+        return missing
+
+    def choose(self, node):
+        if node.work <= self.ledger.work:
+            return False
+        branch=[]
+        while not self.onActiveChain(node.prevhash, node.height-1):
+            if node.block is None:  #not fully downloaded yet
+                return False
+            branch.append(node)
+            node=self.tree.get(node.prevhash)
+            if node is None:
+                return False
+        if node.block is None:
+            return False
+        branch.append(node)
+        branch.reverse()
+        self.reorganize(branch[0].height, [n.block for n in branch])
+        return True
+
+    def reorganize(self, height, blocks):
+        #rolls back only the suffix above the fork point and applies the winning branch
+        work=self.ledger.workAt(height)
+        removed=self.ledger.rollback(height)
+        for block in removed:  #keep the old branch around in case it wins again
+            work+=self.ledger.blockWork(block)
+            node=TreeNode(block.hash, block.prevhash, height, work, block.timestamp, block.target)
+            node.block=block
+            self.tree[block.hash]=node
+            height+=1
+        for block in blocks:
+            self.ledger.appendMinedBlock(block)
+            self.tree.pop(block.hash, None)
+        for blockhash in [h for h, n in self.tree.items() if n.height < self.ledger.height-MAX_FORK_DEPTH]:
+            del self.tree[blockhash]
+        self.node.chainReorganized(removed, blocks)
+
+    def locator(self):
+        #active chain hashes at exponentially spaced heights back from the tip, for the peer to find the fork point
+        entries, step, height = [], 1, self.ledger.height-1
+        while height > 0:
+            entries.append("%d:%s" % (height, binascii.hexlify(self.ledger.chain[height].hash)))
+            if len(entries) >= 10:
+                step*=2
+            height-=step
+        entries.append("0:%s" % (binascii.hexlify(self.ledger.chain[0].hash)))
+        return entries
+
+
+
+class PeerProtocol(LineReceiver):
+    #node to node link: peers announce their tip and work, fetch the headers past the fork point
+    #and download the blocks only for a branch with more work than their own
+    MAX_LENGTH=4*MAX_BLOCK_BYTES # a full block is sent base64 encoded on one line
+
+    def __init__(self, peers):
+        self.peers = peers
+        self.ledger = peers.ledger
+        self.forks = peers.node.forks
+        self.peerWork = 0
+        self.syncing = False
+        self.headers = []
+        self.wanted = [] # (start, count) block ranges still to request for the branch being fetched
+        self.commands = {"tip": self.handle_TIP, "getheaders": self.handle_GETHEADERS, "header": self.handle_HEADER, "endheaders": self.handle_ENDHEADERS,
+                         "getblocks": self.handle_GETBLOCKS, "block": self.handle_BLOCK, "endblocks": self.handle_ENDBLOCKS}
+
+    def connectionMade(self):
+        self.peers.connected.append(self)
+        self.sendTip()
+
+    def connectionLost(self, reason):
+        if self in self.peers.connected:
+            self.peers.connected.remove(self)
+
+    def sendTip(self):
+        self.sendLine("tip %d %s %d" % (self.ledger.height, binascii.hexlify(self.ledger.getLastBlock().hash), self.ledger.work))
+
+    def lineReceived(self, line):
+        arguments = line.split(" ")
+        if arguments[0] in self.commands:
+            try:
+                self.commands[arguments[0]](*arguments[1:])
+            except (TypeError, ValueError):  #malformed message, drop the peer
+                self.transport.loseConnection()
+
+    def requestHeaders(self, after=None):
+        self.syncing = True
+        locator = self.forks.locator()
+        if after is not None:
+            locator.insert(0, "%d:%s" % (after.height, binascii.hexlify(after.hash)))
+        self.sendLine("getheaders " + " ".join(locator))
+
+    def handle_TIP(self, height, tiphash, work):
+        self.peerWork = int(work)
+        if self.peerWork > self.ledger.work and not self.syncing:
+            self.requestHeaders()
+
+    def handle_GETHEADERS(self, *locator):
+        start = 0
+        for entry in locator:
+            height, blockhash = entry.split(":")
+            if self.forks.onActiveChain(binascii.unhexlify(blockhash), int(height)):
+                start = int(height)+1
+                break
+        for height in range(start, min(start+SYNC_BATCH, self.ledger.height)):
+            self.sendLine("header %d %s" % (height, base64.b64encode(self.ledger.chain[height].header())))
+        self.sendLine("endheaders")
+
+    def handle_HEADER(self, height, header):
+        node = self.forks.addHeader(int(height), base64.b64decode(header))
+        if node is not None:
+            self.headers.append(node)
+
+    def handle_ENDHEADERS(self):
+        headers, self.headers = self.headers, []
+        if not headers:
+            self.syncing = False
+        elif headers[-1].work > self.ledger.work:
+            #the whole branch back to the fork point, as earlier header batches may not have won on their own
+            missing = self.forks.missing(headers[-1])
+            if missing:
+                self.wanted = []
+                for node in missing:
+                    if self.wanted and self.wanted[-1][0]+self.wanted[-1][1] == node.height and self.wanted[-1][1] < SYNC_BATCH:
+                        self.wanted[-1] = (self.wanted[-1][0], self.wanted[-1][1]+1)
+                    else:
+                        self.wanted.append((node.height, 1))
+                self.requestBlocks()
+            else:
+                self.syncing = False
+                self.forks.choose(headers[-1])
+        elif len(headers) == SYNC_BATCH:  #the branch may still overtake us further on
+            self.requestHeaders(after=headers[-1])
+        else:
+            self.syncing = False
+
+    def requestBlocks(self):
+        start, count = self.wanted.pop(0)
+        self.sendLine("getblocks %d %d" % (start, count))
+
+    def handle_GETBLOCKS(self, start, count):
+        start = int(start)
+        for height in range(start, min(start+min(int(count), SYNC_BATCH), self.ledger.height)):
+            self.sendLine("block %d %s" % (height, base64.b64encode(self.ledger.chain[height].toBytes())))
+        self.sendLine("endblocks")
+
+    def handle_BLOCK(self, height, record):
+        self.forks.addBlock(int(height), Block.fromBytes(base64.b64decode(record)))
+
+    def handle_ENDBLOCKS(self):
+        if self.wanted:
+            self.requestBlocks()
+            return
+        self.syncing = False
+        if self.peerWork > self.ledger.work:
+            self.requestHeaders()
+
+
+class PeerFactory(Factory):
+
+    def __init__(self, node):
+        self.node = node
+        self.ledger = node.ledger
+        self.connected = []
+
+    def buildProtocol(self, addr):
+        return PeerProtocol(self)
+
+    def connect(self, host, port):
+        reactor.connectTCP(host, port, PeerConnector(self))
+
+    def announce(self):
+        for peer in self.connected:
+            peer.sendTip()
+
+
+class PeerConnector(ReconnectingClientFactory):
+    #outgoing link to a configured peer, retried with backoff while the peer is down
+
+    def __init__(self, peers):
+        self.peers = peers
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return self.peers.buildProtocol(addr)
+
+
+class FramedProtocol(Int32StringReceiver):
+    #binary interface for machine clients and sibling nodes: every frame is a request id, an opcode and a
+    #packed payload; replies carry the same id and opcode plus a status, so many requests can be in flight
+    MAX_LENGTH=4*MAX_BLOCK_BYTES
+
+    def __init__(self, node):
+        self.node = node
+        self.ledger = node.ledger
+        self.forks = node.forks
+        self.operations = {OP_TIP: self.handle_TIP, OP_HEADERS: self.handle_HEADERS, OP_BLOCKS: self.handle_BLOCKS,
+                           OP_BLOCK: self.handle_BLOCK, OP_BALANCE: self.handle_BALANCE, OP_TOTALS: self.handle_TOTALS,
+                           OP_SUBMIT: self.handle_SUBMIT}
+
+    def stringReceived(self, frame):
+        try:
+            request_id, op = FRAME.unpack_from(frame)
+        except struct.error:  #not even a header, drop the client
+            self.transport.loseConnection()
+            return
+        payload = frame[FRAME.size:]
+        if op == OP_VERIFY:
+            d = self.ledger.isValidParallel(self.node.miner, full=payload[:1] == '\x01')
+            d.addCallback(lambda result: self.reply(request_id, op, STATUS_OK, '\x01' if result[1] else '\x00'))
+        elif op == OP_BATCH:
+            self.reply(request_id, op, *self.handle_BATCH(payload))
+        else:
+            self.reply(request_id, op, *self.dispatch(op, payload))
+
+    def reply(self, request_id, op, status, payload):
+        frame = RESPONSE.pack(request_id, op, status) + payload
+        self.node.metrics.sent("framed", len(frame)+4)
+        self.sendString(frame)
+
+    def dispatch(self, op, payload):
+        if op not in self.operations:
+            return STATUS_BAD_REQUEST, ''
+        started = time.time()
+        try:
+            return self.operations[op](payload)
+        except (struct.error, TypeError, ValueError, IndexError):
+            return STATUS_BAD_REQUEST, ''
+        finally:
+            self.node.metrics.record("framed", time.time()-started)
+
+    def handle_BATCH(self, payload):
+        #count, then length-prefixed (opcode, payload) entries; answered in order as (status, payload) entries
+        try:
+            count, offset, replies = COUNT.unpack_from(payload)[0], COUNT.size, []
+            for entry in range(count):
+                length = LENGTH.unpack_from(payload, offset)[0]
+                request = payload[offset+LENGTH.size:offset+LENGTH.size+length]
+                offset += LENGTH.size+length
+                status, body = self.dispatch(ord(request[0]), request[1:])
+                replies.append(LENGTH.pack(len(body)+1) + chr(status) + body)
+        except (struct.error, IndexError):
+            return STATUS_BAD_REQUEST, ''
+        return STATUS_OK, COUNT.pack(len(replies)) + ''.join(replies)
+
+    def handle_TIP(self, payload):
+        work = binascii.unhexlify('%064x' % self.ledger.work)
+        return STATUS_OK, TIP.pack(self.ledger.height, self.ledger.getLastBlock().hash, work)
+
+    def handle_HEADERS(self, payload):
+        #locator entries (height, hash) newest first, headers follow the first one on the active chain
+        start = 0
+        for position in range(COUNT.unpack_from(payload)[0]):
+            height, blockhash = LOCATOR.unpack_from(payload, COUNT.size+position*LOCATOR.size)
+            if self.forks.onActiveChain(blockhash, height):
+                start = height+1
+                break
+        heights = range(start, min(start+SYNC_BATCH, self.ledger.height))
+        return STATUS_OK, COUNT.pack(len(heights)) + ''.join(HEIGHT.pack(height) + self.ledger.chain[height].header() for height in heights)
+
+    def handle_BLOCKS(self, payload):
+        start, count = RANGE.unpack(payload)
+        records = [self.ledger.chain[height].toBytes() for height in range(start, min(start+min(count, SYNC_BATCH), self.ledger.height))]
+        return STATUS_OK, HEIGHT.pack(start) + COUNT.pack(len(records)) + ''.join(LENGTH.pack(len(record)) + record for record in records)
+
+    def handle_BLOCK(self, payload):
+        height = self.ledger.findBlock(binascii.hexlify(payload) if len(payload) == 32 else str(HEIGHT.unpack(payload)[0]))
+        if height is None:
+            return STATUS_NOT_FOUND, ''
+        return STATUS_OK, HEIGHT.pack(height) + self.ledger.chain[height].toBytes()
+
+    def handle_BALANCE(self, payload):
+        return STATUS_OK, BALANCE.pack(*self.ledger.getBalance(payload))
+
+    def handle_TOTALS(self, payload):
+        index = self.ledger.getIndex()
+        body = COUNT.pack(len(index.addresses))
+        for addr in index.addresses:
+            body += pack_field(addr) + BALANCE.pack(*index.balance(addr))
+        body += COUNT.pack(len(index.types))
+        for block_type in sorted(index.types):
+            body += pack_field(block_type) + AMOUNT.pack(index.types[block_type])
+        return STATUS_OK, body
+
+    def handle_SUBMIT(self, payload):
+        #a block pushed by a sibling node goes through the same fork choice as blocks fetched from peers
+        node = self.forks.addBlock(HEIGHT.unpack_from(payload)[0], Block.fromBytes(payload[HEIGHT.size:]))
+        return (STATUS_OK if node is not None else STATUS_REJECTED), ''
+
+
+class FramedFactory(Factory):
+
+    def __init__(self, node):
+        self.node = node
+
+    def buildProtocol(self, addr):
+        return FramedProtocol(self.node)
+
+
+class BlockChainFactory(Factory):
+
+    def __init__(self, datadir=DATA_DIR, blockInterval=BLOCK_INTERVAL, maxBlockTransactions=MAX_BLOCK_TRANSACTIONS,
+                 snapshotInterval=SNAPSHOT_INTERVAL, pruneDepth=PRUNE_DEPTH, credentials=None,
+                 maxConnections=MAX_CONNECTIONS, maxConnectionsPerIP=MAX_CONNECTIONS_PER_IP, idleTimeout=IDLE_TIMEOUT):
         self.users = {} # maps user names to Chat instances
         self.instances = {}
+        self.maxConnections = maxConnections
+        self.maxConnectionsPerIP = maxConnectionsPerIP
+        self.loginTimeout = LOGIN_TIMEOUT
+        self.idleTimeout = idleTimeout
+        self.connections = {} # peer IP -> open user interface connections
+        self.connected = 0
+        self.mempool = Mempool()
+        self.metrics = Metrics()
+        self.proposals = ProposalTable(self.proposalExpired, self.proposalSuperseded)
+        self.blockInterval = blockInterval
+        self.maxBlockTransactions = maxBlockTransactions
+        self.blockTimer = None
+        self.mining = False
+        self.settling = False # an adjust batch is queued and its Adjustment block not mined yet
+        self.store = BlockStore(datadir)
+        self.credentials = credentials if credentials is not None else CredentialStore(os.path.join(datadir, CREDENTIALS_FILE))
+        self.snapshotPath = os.path.join(datadir, SNAPSHOT_FILE)
+        self.snapshotInterval = snapshotInterval
+        self.snapshotting = False
+        self.pruneDepth = pruneDepth
+        self.ledger = BlockChain(self.store) # shared chain every block is mined on once
+        snapshot = Snapshot.load(self.snapshotPath)
+        self.snapshotHeight = snapshot.height if snapshot is not None and self.ledger.restore(snapshot) else 0
+        self.syncer = task.LoopingCall(self.store.sync)
+        self.syncer.start(FSYNC_INTERVAL, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.store.close)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.metrics.dump, os.path.join(datadir, 'metrics.json'))
+        self.miner = ParallelMiner()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.miner.close)
+        self.forks = ForkChoice(self)
+        self.taxes = TaxEngine(Block.fromBytes, os.path.join(datadir, TAXES_FILE))
+        self.taxes.start(self.store)
+        self.peers = PeerFactory(self)
+        self.framed = FramedFactory(self)
+        self.web = ApiSite(ApiResource(self))
     def buildProtocol(self, addr):
-        return BlockChainP2P(self.users,self.instances)
+        #over either limit the connection is closed before a protocol is built for it
+        if self.connected >= self.maxConnections or self.connections.get(addr.host, 0) >= self.maxConnectionsPerIP:
+            return None
+        protocol = BlockChainP2P(self.users,self.instances,self.miner,self.ledger)
+        protocol.factory = self
+        return protocol
+
+    def connectionOpened(self, protocol):
+        host = protocol.transport.getPeer().host
+        self.connections[host] = self.connections.get(host, 0)+1
+        self.connected += 1
+
+    def connectionClosed(self, protocol):
+        host = protocol.transport.getPeer().host
+        self.connections[host] -= 1
+        self.connected -= 1
+        if not self.connections[host]:
+            del self.connections[host]
+
+    def shareBlock(self, block):
+        #the ledger checked the block as it appended it, so the views only follow its tip
+        for name in self.instances.keys():
+            self.instances[name].extendFrom(self.ledger)
+        return block
+
+    def chainReorganized(self, removed, applied):
+        #the ledger's storage was cut at the fork point, so every view is pointed at it again
+        for name in self.instances.keys():
+            self.instances[name].syncFrom(self.ledger)
+        self.taxes.reorganized(self.ledger.height-len(applied), applied)
+        self.maintain()
+        confirmed=set(tx.calcHash() for block in applied for tx in block.transactions)
+        for block in removed:  #transactions only the losing branch had go back to the pool
+            for tx in block.transactions:
+                if tx.calcHash() not in confirmed:
+                    self.mempool.add(tx)
+        self.peers.announce()
+        self.scheduleBlock()
+
+    def proposalExpired(self, proposal):
+        for name in (proposal.proposer, proposal.counterparty):
+            if name in self.users:
+                self.users[name].sendLine("\n[!]Proposal " + str(proposal.id) + " Expired without Approval\n")
+
+    def proposalSuperseded(self, proposal, replacement):
+        for name in (proposal.proposer, proposal.counterparty):
+            if name in self.users:
+                self.users[name].sendLine("\n[!]Proposal " + str(proposal.id) + " was Replaced by Proposal " + str(replacement.id) + "\n")
+
+    def submitTransaction(self, tx):
+        #fires with the block once the transaction has been mined into the ledger
+        d=defer.Deferred()
+        self.mempool.add(tx, d)
+        self.scheduleBlock()
+        return d
+
+    def scheduleBlock(self):
+        if self.mining or not len(self.mempool):
+            return
+        if len(self.mempool) >= self.maxBlockTransactions:
+            self.mineTemplate()
+        elif self.blockTimer is None:
+            self.blockTimer=reactor.callLater(self.blockInterval, self.mineTemplate)
+
+    def mineTemplate(self):
+        #one proof of work for every transaction in the template
+        if self.blockTimer is not None and self.blockTimer.active():
+            self.blockTimer.cancel()
+        self.blockTimer=None
+        entries=self.mempool.template(self.maxBlockTransactions, MAX_BLOCK_BYTES)
+        if not entries:
+            return
+        self.mining=True
+        block=Block.fromTransactions(random.randint(1,1001), timestamp_now(), [tx for tx, d in entries])
+        started=time.time()
+        d=self.ledger.mineNewBlock(block, self.miner)
+        d.addBoth(lambda result: self.metrics.timed("mining", time.time()-started) or result)
+        d.addCallback(self.blockAdded)
+        d.addBoth(self.templateDone, entries)
+
+    def templateDone(self, result, entries):
+        self.mining=False
+        for tx, d in entries:
+            if d is None:
+                continue
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        self.scheduleBlock()
+
+    def maintain(self):
+        #bounds the decoded blocks held in memory and snapshots the ledger every snapshotInterval blocks
+        self.ledger.blocks.evict(self.ledger.height-self.pruneDepth)
+        if not self.snapshotting and self.ledger.height >= self.snapshotHeight+self.snapshotInterval:
+            self.snapshotting = True
+            height = self.ledger.height
+            d = self.ledger.isValidParallel(self.miner)  #only a verified prefix is snapshotted
+            d.addCallback(self.snapshotVerified, height)
+            d.addBoth(self.snapshotDone)
+
+    def snapshotVerified(self, result, height):
+        height = min(height, self.ledger.verified, self.ledger.height)  #a reorg meanwhile may have cut the chain
+        if result[1] and height > self.snapshotHeight:
+            self.ledger.snapshot(height).save(self.snapshotPath)
+            self.snapshotHeight = height
+
+    def snapshotDone(self, result):
+        self.snapshotting = False
+        return result
+
+    def blockAdded(self, block):
+        #a block mined here reaches every local view and is announced to the connected peers
+        started=time.time()
+        self.shareBlock(block)
+        self.taxes.blocksAdded([block])
+        self.maintain()
+        self.peers.announce()
+        self.metrics.timed("reactor", time.time()-started)
+        return block
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BlockChain P2P node")
+    parser.add_argument("--port", type=int, default=8123, help="port for the user command interface")
+    parser.add_argument("--peer-port", type=int, default=None, help="port to accept connections from other nodes on")
+    parser.add_argument("--framed-port", type=int, default=None, help="port for the binary framed protocol used by machine clients and sibling nodes")
+    parser.add_argument("--http-port", type=int, default=None, help="port for the read-only JSON API used by dashboards and auditors")
+    parser.add_argument("--peer", action="append", default=[], help="host:port of another node to connect to, may be repeated")
+    parser.add_argument("--datadir", default=DATA_DIR, help="directory of the block store")
+    parser.add_argument("--block-interval", type=float, default=BLOCK_INTERVAL, help="seconds approved transactions are batched before mining")
+    parser.add_argument("--max-block-transactions", type=int, default=MAX_BLOCK_TRANSACTIONS, help="transactions per block")
+    parser.add_argument("--credentials", default=None, help="credentials file, created with the default accounts if missing (default: <datadir>/credentials)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="user interface connections accepted at once")
+    parser.add_argument("--max-connections-per-ip", type=int, default=MAX_CONNECTIONS_PER_IP, help="user interface connections accepted from one address")
+    parser.add_argument("--idle-timeout", type=int, default=IDLE_TIMEOUT, help="seconds before a silent session is disconnected")
+    parser.add_argument("--snapshot-interval", type=int, default=SNAPSHOT_INTERVAL, help="blocks between ledger snapshots")
+    parser.add_argument("--prune-depth", type=int, default=PRUNE_DEPTH, help="blocks below the tip kept in memory")
+    args = parser.parse_args(argv)
 
+    credentials = CredentialStore(args.credentials) if args.credentials else None
+    factory = BlockChainFactory(args.datadir, args.block_interval, args.max_block_transactions, args.snapshot_interval, args.prune_depth,
+                                credentials, args.max_connections, args.max_connections_per_ip, args.idle_timeout)
+    reactor.listenTCP(args.port, factory)
+    if args.peer_port:
+        reactor.listenTCP(args.peer_port, factory.peers)
+    if args.framed_port:
+        reactor.listenTCP(args.framed_port, factory.framed)
+    if args.http_port:
+        reactor.listenTCP(args.http_port, factory.web)
+    for peer in args.peer:
+        host, port = peer.rsplit(":", 1)
+        factory.peers.connect(host, int(port))
+    reactor.run()
 
-reactor.listenTCP(8123, BlockChainFactory())
-reactor.run()
 
+if __name__ == "__main__":
+    main()
@@ -62,6 +62,15 @@ class BlockChain():
         newBlock.mineBlock(self.difficulty)
         self.chain.append(newBlock)
 
+    def appendMinedBlock(self, block):
+        #appends a block mined elsewhere by reference, after checking its header against this chain's tip
+        if block.prevhash != self.getLastBlock().hash:
+            return False
+        if block.hash != block.calcHash() or block.hash[:self.difficulty] != str('').zfill(self.difficulty):
+            return False
+        self.chain.append(block)
+        return True
+
     def isValid(self):
         string=''
         for index in range(1,len(self.chain)):
@@ -112,10 +121,10 @@ class BlockChain():
 
 class BlockChainP2P(LineReceiver):
 
-    def __init__(self, users,instances):
+    def __init__(self, users,instances,ledger):
         self.instances= instances
         #self.instances[]={self.useself.blockchain=BlockChain()}
-        self.blockchain=BlockChain()
+        self.ledger=ledger
         self.users = users
         self.name = None
         self.state = "GETNAME"
@@ -141,7 +150,7 @@ class BlockChainP2P(LineReceiver):
         self.sendLine("Welcome, %s!" % (name))
         self.name = name
         self.users[name] = self
-        self.instances[name]=copy.deepcopy(self.blockchain)
+        self.instances[name]=copy.deepcopy(self.ledger)
         self.state = "CHAT"
 
     def handle_CHAT(self, message):
@@ -187,10 +196,12 @@ class BlockChainP2P(LineReceiver):
             elif len(arguments)==4:
 		message = "\n[*]Adding New Block for Transaction\n"
 
-        
-		for name in self.instances.keys():
-			#self.blockchain.addNewBlock(Block(random.randint(1,1001),str(datetime.now()),int(arguments[3]),arguments[1],arguments[2]))
-			self.instances[name].addNewBlock(Block(random.randint(1,1001),str(datetime.now()),int(arguments[3]),arguments[1],arguments[2]))
+                #mined once on the shared ledger, then the same block is appended to every user's view
+                block=Block(random.randint(1,1001),str(datetime.now()),int(arguments[3]),arguments[1],arguments[2])
+                self.ledger.addNewBlock(block)
+                for name in self.instances.keys():
+                    if not self.instances[name].appendMinedBlock(block):
+                        self.instances[name]=copy.deepcopy(self.ledger)
 
     		#self.blockchain.addNewBlock(Block(random.randint(1,1001),str(datetime.now()),50,'Addr1','Addr2'))
     		#self.blockchain.addNewBlock(Block(random.randint(1,1001),str(datetime.now()),230,'Addr2','Addr3'))
@@ -213,9 +224,15 @@ class BlockChainFactory(Factory):
     def __init__(self):
         self.users = {} # maps user names to Chat instances
         self.instances = {}
+        self.ledger = BlockChain() # shared chain every block is mined on once
     def buildProtocol(self, addr):
-        return BlockChainP2P(self.users,self.instances)
+        return BlockChainP2P(self.users,self.instances,self.ledger)
+
+
+def main():
+    reactor.listenTCP(8123, BlockChainFactory())
+    reactor.run()
 
 
-reactor.listenTCP(8123, BlockChainFactory())
-reactor.run()
+if __name__ == "__main__":
+    main()
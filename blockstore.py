@@ -0,0 +1,132 @@
+import os
+import mmap
+import struct
+import binascii
+
+
+RECORD=struct.Struct('>I') # length prefix of every block record in blocks.dat
+ENTRY=struct.Struct('>Q32s') # one entry per height in blocks.idx: record offset, cumulative work up to that height
+FSYNC_BATCH=64
+
+
+class BlockStore():
+    #append-only segment of length-prefixed block records plus a height->(offset, cumulative work) index
+    #the index is memory mapped on open, so startup cost does not depend on the number of blocks
+
+    def __init__(self, path, fsync_batch=FSYNC_BATCH):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path=path
+        self.data=open(os.path.join(path, 'blocks.dat'), 'a+b')
+        self.index=open(os.path.join(path, 'blocks.idx'), 'a+b')
+        self.reader=open(os.path.join(path, 'blocks.dat'), 'rb')
+        self.fsync_batch=fsync_batch
+        self.pending=0
+        self.map=None
+        self.recover()
+        self.remap()
+
+    def readOffset(self, height):
+        self.index.seek(height*ENTRY.size)
+        return ENTRY.unpack(self.index.read(ENTRY.size))[0]
+
+    def readRecord(self, offset):
+        self.reader.seek(offset)
+        length=RECORD.unpack(self.reader.read(RECORD.size))[0]
+        return self.reader.read(length)
+
+    def recover(self):
+        #drops a torn index entry or record left behind by a crash between two fsyncs
+        size=os.fstat(self.data.fileno()).st_size
+        count=os.fstat(self.index.fileno()).st_size//ENTRY.size
+        self.end=0
+        while count:
+            offset=self.readOffset(count-1)
+            if offset+RECORD.size <= size:
+                self.reader.seek(offset)
+                end=offset+RECORD.size+RECORD.unpack(self.reader.read(RECORD.size))[0]
+                if end <= size:
+                    self.end=end
+                    break
+            count-=1
+        self.index.truncate(count*ENTRY.size)
+        self.data.truncate(self.end)
+        self.index.seek(0, os.SEEK_END)
+        self.data.seek(0, os.SEEK_END)
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        size=os.fstat(self.index.fileno()).st_size
+        self.map=mmap.mmap(self.index.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        self.mapped=size//ENTRY.size
+        self.entries=[] # (offset, cumulative work) appended since the index was mapped
+
+    def __len__(self):
+        return self.mapped+len(self.entries)
+
+    def entry(self, height):
+        if height < self.mapped:
+            offset, work = ENTRY.unpack_from(self.map, height*ENTRY.size)
+            return offset, int(binascii.hexlify(work), 16)
+        return self.entries[height-self.mapped]
+
+    def offset(self, height):
+        return self.entry(height)[0]
+
+    def work(self, height):
+        #cumulative work of the blocks up to and including `height`
+        return self.entry(height)[1]
+
+    def get(self, height):
+        return self.readRecord(self.offset(height))
+
+    def records(self, start, end):
+        #reads through handles of its own, so a worker thread can scan history while the reactor appends
+        with open(os.path.join(self.path, 'blocks.idx'), 'rb') as index:
+            with open(os.path.join(self.path, 'blocks.dat'), 'rb') as data:
+                index.seek(start*ENTRY.size)
+                for height in range(start, end):
+                    data.seek(ENTRY.unpack(index.read(ENTRY.size))[0])
+                    length=RECORD.unpack(data.read(RECORD.size))[0]
+                    yield data.read(length)
+
+    def append(self, record, work=0):
+        #`work` is the block's own proof of work, the index keeps the running total
+        work+=self.work(len(self)-1) if len(self) else 0
+        self.data.write(RECORD.pack(len(record)) + record)
+        self.data.flush()
+        self.index.write(ENTRY.pack(self.end, binascii.unhexlify('%064x' % work)))
+        self.index.flush()
+        self.entries.append((self.end, work))
+        self.end+=RECORD.size+len(record)
+        self.pending+=1
+        if self.pending >= self.fsync_batch:
+            self.sync()
+
+    def truncate(self, height):
+        #drops every record from `height` on, used when the chain is rolled back to a fork point
+        if height >= len(self):
+            return
+        self.end=self.offset(height)
+        if self.map is not None:
+            self.map.close()
+            self.map=None
+        self.index.truncate(height*ENTRY.size)
+        self.data.truncate(self.end)
+        self.pending+=1
+        self.sync()
+        self.remap()
+
+    def sync(self):
+        if self.pending:
+            os.fsync(self.data.fileno())
+            os.fsync(self.index.fileno())
+            self.pending=0
+
+    def close(self):
+        self.sync()
+        if self.map is not None:
+            self.map.close()
+        for f in (self.data, self.index, self.reader):
+            f.close()
@@ -0,0 +1,84 @@
+import os
+import sys
+import hmac
+import getpass
+import hashlib
+import binascii
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+
+ITERATIONS=100000 # pbkdf2-sha256 rounds for new passwords
+SALT_BYTES=16
+CHECK_THREADS=2 # password checks run here, never on the pool mining and verification use
+DEFAULT_ACCOUNTS={"Supplier":"supplier","CompanyA":"compa", "CompanyB":"compb", "CBDT":"cbdt", "Auditors":"auditors"} # written on first start only
+
+
+def hash_password(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+
+class CredentialStore():
+    #salted pbkdf2 password hashes, one "name salt iterations hash" line per user, loaded once per node
+
+    def __init__(self, path=None, iterations=ITERATIONS):
+        self.path=path
+        self.iterations=iterations
+        self.users={} # name -> (salt, iterations, hash)
+        self.pool=None
+        if path is not None and os.path.exists(path):
+            self.load()
+        elif path is not None:
+            for name in sorted(DEFAULT_ACCOUNTS):
+                self.add(name, DEFAULT_ACCOUNTS[name])
+            self.save()
+        self.dummy=(os.urandom(SALT_BYTES), iterations, os.urandom(32)) # unknown names cost as much as wrong passwords
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    name, salt, iterations, digest = line.split()
+                    self.users[name]=(binascii.unhexlify(salt), int(iterations), binascii.unhexlify(digest))
+
+    def save(self):
+        with open(self.path+".tmp", 'w') as f:
+            for name in sorted(self.users):
+                salt, iterations, digest = self.users[name]
+                f.write("%s %s %d %s\n" % (name, binascii.hexlify(salt), iterations, binascii.hexlify(digest)))
+        os.chmod(self.path+".tmp", 0o600)
+        os.rename(self.path+".tmp", self.path)
+
+    def add(self, name, password, iterations=None):
+        salt=os.urandom(SALT_BYTES)
+        iterations=iterations or self.iterations
+        self.users[name]=(salt, iterations, hash_password(password, salt, iterations))
+
+    def verify(self, name, password):
+        salt, iterations, digest = self.users.get(name, self.dummy)
+        return hmac.compare_digest(hash_password(password, salt, iterations), digest) and name in self.users
+
+    def check(self, name, password):
+        #fires with True or False from a small pool of its own, so a burst of logins cannot delay mining
+        if self.pool is None:
+            self.pool=ThreadPool(1, CHECK_THREADS, "credentials")
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        return threads.deferToThreadPool(reactor, self.pool, self.verify, name, password)
+
+
+def main(argv=None):
+    #python credentials.py <credentials file> <user name> adds a user or changes their password
+    argv=sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        sys.stderr.write("usage: credentials.py <credentials file> <user name>\n")
+        return 1
+    store=CredentialStore(argv[0])
+    store.add(argv[1], getpass.getpass("Password for %s: " % argv[1]))
+    store.save()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
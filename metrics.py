@@ -0,0 +1,84 @@
+import json
+import time
+import bisect
+
+
+LATENCY_BUCKETS=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0) # histogram upper bounds in seconds
+
+
+class CommandStats():
+
+    def __init__(self):
+        self.calls=0
+        self.total=0.0
+        self.max=0.0
+        self.bytes=0
+        self.buckets=[0]*(len(LATENCY_BUCKETS)+1) # the last bucket counts everything slower than the largest bound
+
+    def record(self, elapsed):
+        self.calls+=1
+        self.total+=elapsed
+        self.max=max(self.max, elapsed)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)]+=1
+
+    def histogram(self):
+        labels=["<=%gms" % (bound*1000) for bound in LATENCY_BUCKETS] + [">%gms" % (LATENCY_BUCKETS[-1]*1000)]
+        return [(label, count) for label, count in zip(labels, self.buckets) if count]
+
+    def asDict(self):
+        return {"calls": self.calls, "total_seconds": self.total, "max_seconds": self.max, "bytes_sent": self.bytes,
+                "histogram": dict(self.histogram())}
+
+
+class Metrics():
+    #per-command call counts, latencies and bytes sent, plus where the node's time goes:
+    #"reactor" is time spent handling commands and blocks on the reactor thread,
+    #"mining" and "verifying" are wall time of work handed to the process pool
+
+    def __init__(self, clock=time.time):
+        self.clock=clock
+        self.started=clock()
+        self.commands={}
+        self.timers={}
+
+    def command(self, name):
+        if name not in self.commands:
+            self.commands[name]=CommandStats()
+        return self.commands[name]
+
+    def record(self, name, elapsed):
+        self.command(name).record(elapsed)
+        self.timed("reactor", elapsed)
+
+    def sent(self, name, nbytes):
+        self.command(name).bytes+=nbytes
+
+    def timed(self, name, elapsed):
+        count, total = self.timers.get(name, (0, 0.0))
+        self.timers[name]=(count+1, total+elapsed)
+
+    def asDict(self):
+        return {"uptime_seconds": self.clock()-self.started,
+                "timers": dict((name, {"count": count, "total_seconds": total}) for name, (count, total) in self.timers.items()),
+                "commands": dict((name, stats.asDict()) for name, stats in self.commands.items())}
+
+    def toJSON(self):
+        return json.dumps(self.asDict(), sort_keys=True)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.toJSON())
+
+    def summary(self):
+        string="Uptime: %.1fs\n" % (self.clock()-self.started)
+        for name in sorted(self.timers):
+            count, total = self.timers[name]
+            string+="%s: %.4fs over %d calls\n" % (name.capitalize(), total, count)
+        string+="\n%-14s %8s %10s %10s %10s\n" % ("Command", "Calls", "Avg ms", "Max ms", "Bytes")
+        for name in sorted(self.commands):
+            stats=self.commands[name]
+            average=stats.total/stats.calls*1000 if stats.calls else 0.0
+            string+="%-14s %8d %10.3f %10.3f %10d\n" % (name, stats.calls, average, stats.max*1000, stats.bytes)
+            if stats.calls:
+                string+="    " + " ".join("%s:%d" % (label, count) for label, count in stats.histogram()) + "\n"
+        return string
@@ -0,0 +1,91 @@
+import hashlib
+import binascii
+import struct
+import multiprocessing
+from twisted.internet import threads
+
+
+CHUNK_SIZE=20000
+POLL_INTERVAL=0.1 # seconds between checks for a closed pool while a round is running
+NONCE=struct.Struct('>Q') # nonce encoding at the end of the header prefix
+
+
+def target_for_difficulty(difficulty):
+    #a hash with `difficulty` leading hex zeros is a digest <= 16^(64-difficulty)-1
+    value=16**(64-max(0, min(difficulty, 64)))-1
+    return binascii.unhexlify('%064x' % value)
+
+
+def work_for_target(target):
+    #expected number of hashes to find a digest <= target
+    return 2**256//(int(binascii.hexlify(target), 16)+1)
+
+
+def search_range(job):
+    #worker entry point: the header prefix is hashed once, every nonce only costs a copy and two updates
+    prefix, suffix, start, count, target = job
+    base=hashlib.sha256(prefix)
+    for nonce in range(start, start+count):
+        h=base.copy()
+        h.update(NONCE.pack(nonce))
+        h.update(suffix)
+        if h.digest() <= target:
+            return nonce
+    return None
+
+
+def hash_headers(headers):
+    return [hashlib.sha256(header).digest() for header in headers]
+
+
+class MinerClosed(Exception):
+    pass
+
+
+class ParallelMiner():
+
+    def __init__(self, processes=None, chunk_size=CHUNK_SIZE):
+        self.processes=processes or multiprocessing.cpu_count()
+        self.chunk_size=chunk_size
+        self.pool=multiprocessing.Pool(self.processes)
+        self.closed=False
+
+    def map(self, f, jobs):
+        #pool.map from a reactor thread, given up once the pool is closed so the thread can still be joined at shutdown
+        result=self.pool.map_async(f, jobs)
+        while not result.ready():
+            if self.closed:
+                raise MinerClosed()
+            result.wait(POLL_INTERVAL)
+        return result.get()
+
+    def search(self, prefix, suffix, start, target):
+        #splits the nonce space into one chunk per worker and returns the lowest winning nonce of the first round that finds one
+        while True:
+            jobs=[(prefix, suffix, start+i*self.chunk_size, self.chunk_size, target) for i in range(self.processes)]
+            for nonce in self.map(search_range, jobs):
+                if nonce is not None:
+                    return nonce
+            start+=self.processes*self.chunk_size
+
+    def mine(self, block):
+        #runs the search against the block's target on a reactor thread pool thread and fires with the mined block
+        prefix, suffix = block.headerParts()
+        d=threads.deferToThread(self.search, prefix, suffix, block.nonce, block.target)
+        def found(nonce):
+            block.nonce=nonce
+            block.hash=block.calcHash()
+            return block
+        d.addCallback(found)
+        return d
+
+    def hashHeaders(self, headers):
+        #hashes a batch of block headers across the pool, called from a thread, and returns the digests in order
+        size=len(headers)//self.processes+1
+        chunks=[headers[i:i+size] for i in range(0, len(headers), size)]
+        return [h for part in self.map(hash_headers, chunks) for h in part]
+
+    def close(self):
+        self.closed=True
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,50 @@
+import os
+import json
+import hashlib
+import binascii
+
+
+SNAPSHOT_FILE="snapshot.json"
+
+
+class Snapshot():
+    #address balances and block type totals over the first `height` blocks, tied to the hash of
+    #block height-1; the digest covers both, so a torn or edited file is never loaded
+
+    def __init__(self, height, tiphash, addresses, totals, types):
+        self.height=height
+        self.tiphash=tiphash
+        self.addresses=addresses # in order of first appearance
+        self.totals=totals # address -> [incoming, outgoing, number of blocks touching it]
+        self.types=types # block type -> total transaction value
+
+    def digest(self):
+        state=[self.height, binascii.hexlify(self.tiphash), self.addresses,
+               [self.totals[addr] for addr in self.addresses], sorted(self.types.items())]
+        return hashlib.sha256(json.dumps(state, separators=(',', ':'))).hexdigest()
+
+    def save(self, path):
+        #written next to the old snapshot and renamed over it, so a crash leaves one of the two whole
+        data={"height": self.height, "tip": binascii.hexlify(self.tiphash), "addresses": self.addresses,
+              "totals": [self.totals[addr] for addr in self.addresses], "types": self.types, "digest": self.digest()}
+        with open(path+".tmp", 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path+".tmp", path)
+
+    @staticmethod
+    def load(path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                data=json.load(f)
+            addresses=[str(addr) for addr in data["addresses"]]
+            snapshot=Snapshot(data["height"], binascii.unhexlify(data["tip"]), addresses,
+                              dict(zip(addresses, data["totals"])), dict((str(t), v) for t, v in data["types"].items()))
+            if snapshot.digest() != data["digest"]:
+                return None
+        except (ValueError, KeyError, TypeError):
+            return None
+        return snapshot
@@ -0,0 +1,236 @@
+import os
+import json
+import hashlib
+import binascii
+from array import array
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+
+THRESHOLD_PERCENT=14.5 # profit below this share of the expenditure is adjusted
+ADJUSTMENT_SHARE=0.25 # part of the shortfall paid to CBDT
+TAXED_TYPES=("Sales", "Expenditure")
+CHECKPOINT_INTERVAL=1000 # blocks between stored prefix sums; any other height replays at most this many blocks
+TAXES_FILE="taxes.json"
+
+
+def adjustment_for(sales, expenditure):
+    #the same rule adjust always applied to a Sales/Expenditure pair, over any totals
+    profit=sales-expenditure
+    threshold=float(THRESHOLD_PERCENT*expenditure)/float(100)
+    if profit > threshold:
+        return 0.0
+    return (threshold-profit)*ADJUSTMENT_SHARE
+
+
+class TaxAggregates():
+    #per-company running Sales and Expenditure totals; entry i of a company's arrays is its total over
+    #blocks [0, i*interval), so memory grows with height/interval and the totals at any other height
+    #are a checkpoint plus a replay of the blocks after it, read back through `read(start, end)`
+    #a transaction is booked to the company that proposed it, which is its to_address
+    #the default settlement cursor only moves when an Adjustment transaction this node queued for a
+    #default settlement is mined, so explicit ranges and other nodes' blocks never move it
+
+    def __init__(self, read, interval=CHECKPOINT_INTERVAL):
+        self.read=read
+        self.interval=interval
+        self.height=0
+        self.companies={} # company -> (sales at every checkpoint, expenditure at every checkpoint)
+        self.current={} # company -> [sales, expenditure] over blocks [0, height)
+        self.settlements=[] # (height of a block holding a default settlement, end of the range it settled)
+        self.adjustments={} # hash of an Adjustment transaction queued for a default settlement -> end of its range
+
+    def book(self, sums, block):
+        for tx in block.transactions:
+            if tx.block_type in TAXED_TYPES:
+                sums.setdefault(tx.to_address, [0.0, 0.0])[TAXED_TYPES.index(tx.block_type)]+=tx.amount
+
+    def apply(self, block):
+        height=self.height
+        self.height+=1
+        self.book(self.current, block)
+        for tx in block.transactions:
+            if tx.block_type == "Adjustment":
+                end=self.adjustments.get(tx.calcHash())
+                if end is not None and self.settlements[-1:] != [(height, end)]:
+                    self.settlements.append((height, end))
+        if self.height % self.interval == 0:
+            checkpoints=self.height//self.interval
+            for company, (sales, expenditure) in self.current.items():
+                if company not in self.companies:
+                    self.companies[company]=(array('d', [0.0])*checkpoints, array('d', [0.0])*checkpoints)
+                self.companies[company][0].append(sales)
+                self.companies[company][1].append(expenditure)
+
+    def truncate(self, height):
+        if height >= self.height:
+            return
+        checkpoint=height//self.interval
+        for sales, expenditure in self.companies.values():
+            del sales[checkpoint+1:]
+            del expenditure[checkpoint+1:]
+        self.current=self.prefixes(checkpoint*self.interval)
+        self.height=checkpoint*self.interval
+        while self.settlements and self.settlements[-1][0] >= self.height:
+            self.settlements.pop()
+        for block in self.read(self.height, height):
+            self.apply(block)
+
+    def expect(self, hashes, end):
+        self.adjustments.update((txhash, end) for txhash in hashes)
+
+    def checkpoint(self):
+        return self.height-self.height%self.interval
+
+    def prefixes(self, height):
+        #company -> [sales, expenditure] over blocks [0, height)
+        if height == self.height:
+            return dict((company, list(sums)) for company, sums in self.current.items())
+        checkpoint=height//self.interval
+        sums=dict((company, [sales[checkpoint], expenditure[checkpoint]]) for company, (sales, expenditure) in self.companies.items()
+                  if len(sales) > checkpoint)
+        for block in self.read(checkpoint*self.interval, height):
+            self.book(sums, block)
+        return sums
+
+    def clamp(self, start, end):
+        end=self.height if end is None else max(0, min(end, self.height))
+        return max(0, min(start, end)), end
+
+    def totals(self, company, start=0, end=None):
+        start, end = self.clamp(start, end)
+        low, high = self.prefixes(start).get(company, [0.0, 0.0]), self.prefixes(end).get(company, [0.0, 0.0])
+        return high[0]-low[0], high[1]-low[1]
+
+    def unsettled(self):
+        #blocks from the end of the last mined settlement on, including any mined while it waited for its block
+        return max(end for height, end in self.settlements) if self.settlements else 0
+
+    def settlement(self, start=None, end=None):
+        start, end = self.clamp(self.unsettled() if start is None else start, end)
+        low, high = self.prefixes(start), self.prefixes(end)
+        rows=[]
+        for company in sorted(high):
+            sales, expenditure = [h-l for h, l in zip(high[company], low.get(company, [0.0, 0.0]))]
+            if sales or expenditure:
+                rows.append((company, sales, expenditure, adjustment_for(sales, expenditure)))
+        return start, end, rows
+
+    def state(self, tiphash):
+        #everything needed to resume at the last checkpoint height, tied to the hash of block height-1
+        height=self.checkpoint()
+        return {"height": height, "tip": binascii.hexlify(tiphash), "settlements": [entry for entry in self.settlements if entry[0] < height],
+                "adjustments": dict((binascii.hexlify(txhash), end) for txhash, end in self.adjustments.items()),
+                "companies": dict((company, [list(sales), list(expenditure)]) for company, (sales, expenditure) in self.companies.items())}
+
+    def restore(self, state):
+        #the settlements after the checkpoint come back as its blocks are replayed
+        self.height=state["height"]
+        self.settlements=[tuple(entry) for entry in state["settlements"]]
+        self.companies=dict((str(company), (array('d', sales), array('d', expenditure))) for company, (sales, expenditure) in state["companies"].items())
+        self.current=dict((company, [sales[-1], expenditure[-1]]) for company, (sales, expenditure) in self.companies.items())
+
+
+def state_digest(state):
+    return hashlib.sha256(json.dumps(state, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+class TaxEngine():
+    #keeps TaxAggregates in step with the ledger on one dedicated worker thread, so updates
+    #and queries are applied in the order the reactor issued them and never run on the reactor
+    #the aggregates are saved at every checkpoint, so a restart only replays the blocks after the last one
+
+    def __init__(self, decode, path=None):
+        self.decode=decode
+        self.path=path
+        self.store=None
+        self.aggregates=TaxAggregates(self.readBlocks)
+        self.pool=ThreadPool(1, 1, "taxes")
+
+    def start(self, store):
+        self.store=store
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        return self.run(self.load, store, len(store))
+
+    def run(self, f, *args):
+        return threads.deferToThreadPool(reactor, self.pool, f, *args)
+
+    def readBlocks(self, start, end):
+        #history is read through handles of the engine's own, so the reactor can keep appending meanwhile
+        return [self.decode(record) for record in self.store.records(start, end)]
+
+    def load(self, store, end):
+        state=self.loadState()
+        if state is not None:
+            #kept even when the checkpoint is not, the replay below finds the settlements again by transaction hash
+            self.aggregates.adjustments=dict((binascii.unhexlify(txhash), end) for txhash, end in state["adjustments"].items())
+            if 0 < state["height"] <= end and binascii.hexlify(self.tipHash(state["height"])) == state["tip"]:  #saved on a branch since abandoned otherwise
+                self.aggregates.restore(state)
+        last=end-end%self.aggregates.interval  #only the newest checkpoint replayed here is worth saving
+        for record in store.records(self.aggregates.height, end):
+            self.aggregates.apply(self.decode(record))
+            if self.aggregates.height == last:
+                self.saveState()
+
+    def tipHash(self, height):
+        return self.readBlocks(height-1, height)[0].hash if height else ""
+
+    def loadState(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                data=json.load(f)
+            if state_digest(data["state"]) != data["digest"] or "adjustments" not in data["state"]:
+                return None
+        except (ValueError, KeyError, TypeError):
+            return None
+        return data["state"]
+
+    def saveState(self):
+        #written next to the old file and renamed over it, so a crash leaves one of the two whole
+        if self.path is None:
+            return
+        state=self.aggregates.state(self.tipHash(self.aggregates.checkpoint()))
+        with open(self.path+".tmp", 'w') as f:
+            json.dump({"state": state, "digest": state_digest(state)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path+".tmp", self.path)
+
+    def applyBlock(self, block):
+        self.aggregates.apply(block)
+        if self.aggregates.height % self.aggregates.interval == 0:
+            self.saveState()
+
+    def blocksAdded(self, blocks):
+        return self.run(self.applyBlocks, list(blocks))
+
+    def reorganized(self, height, blocks):
+        return self.run(self.rewind, height, list(blocks))
+
+    def applyBlocks(self, blocks):
+        for block in blocks:
+            self.applyBlock(block)
+
+    def rewind(self, height, blocks):
+        #saved again, as the last checkpoint written may be on the branch just abandoned
+        self.aggregates.truncate(height)
+        self.applyBlocks(blocks)
+        self.saveState()
+
+    def expect(self, hashes, end):
+        #Adjustment transactions queued for a default settlement of the blocks before `end`
+        return self.run(self.expectAdjustments, list(hashes), end)
+
+    def expectAdjustments(self, hashes, end):
+        self.aggregates.expect(hashes, end)
+        self.saveState()
+
+    def totals(self, company, start=0, end=None):
+        return self.run(self.aggregates.totals, company, start, end)
+
+    def settlement(self, start=None, end=None):
+        return self.run(self.aggregates.settlement, start, end)
@@ -0,0 +1,112 @@
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet import defer
+from twisted.internet import task
+import blockchain
+from blockchain import Block, Transaction, BlockChainFactory, PeerConnector, timestamp_now
+from credentials import CredentialStore
+
+
+SYNC_TIMEOUT=10.0 # seconds a test waits for the nodes to agree
+
+
+class NodeSyncTest(unittest.TestCase):
+    #two nodes in this process, each with its own store, linked over a loopback peer port
+
+    def setUp(self):
+        self.nodes=[]
+        self.ports=[]
+        self.connectors=[]
+
+    def node(self):
+        node=BlockChainFactory(self.mktemp(), blockInterval=3600, credentials=CredentialStore(iterations=1))
+        self.nodes.append(node)
+        return node
+
+    def mine(self, node, count, company):
+        for i in range(count):
+            block=Block.fromTransactions(1, timestamp_now(), [Transaction("Sales", float(i+1), company, "Supplier")])
+            node.ledger.addNewBlock(block)
+            node.blockAdded(block)
+
+    def link(self, listener, dialer):
+        port=reactor.listenTCP(0, listener.peers, interface="127.0.0.1")
+        self.ports.append(port)
+        connector=PeerConnector(dialer.peers)
+        self.connectors.append(connector)
+        reactor.connectTCP("127.0.0.1", port.getHost().port, connector)
+
+    @defer.inlineCallbacks
+    def waitFor(self, condition):
+        waited=0.0
+        while not condition():
+            if waited > SYNC_TIMEOUT:
+                self.fail("nodes did not converge")
+            yield task.deferLater(reactor, 0.05, lambda: None)
+            waited+=0.05
+
+    def tips(self):
+        return [(node.ledger.height, node.ledger.getLastBlock().hash) for node in self.nodes]
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for connector in self.connectors:
+            connector.stopTrying()
+        for node in self.nodes:
+            for peer in list(node.peers.connected):
+                peer.transport.loseConnection()
+        for port in self.ports:
+            yield port.stopListening()
+        yield self.waitFor(lambda: not any(node.peers.connected for node in self.nodes))
+        for node in self.nodes:
+            if node.blockTimer is not None and node.blockTimer.active():
+                node.blockTimer.cancel()
+            node.syncer.stop()
+            node.taxes.pool.stop()
+            node.miner.close()
+            node.store.close()
+
+    @defer.inlineCallbacks
+    def test_sync(self):
+        a, b = self.node(), self.node()
+        self.mine(a, 3, "CompanyA")
+        self.link(a, b)
+        yield self.waitFor(lambda: b.ledger.height == a.ledger.height)
+        self.assertEqual(self.tips()[0], self.tips()[1])
+        self.assertTrue(b.ledger.isValid(full=True)[1])
+        self.assertEqual(b.ledger.getBalance("CompanyA"), a.ledger.getBalance("CompanyA"))
+
+    @defer.inlineCallbacks
+    def test_reorganize(self):
+        a, b = self.node(), self.node()
+        self.mine(a, 4, "CompanyA")
+        self.mine(b, 2, "CompanyB")
+        self.link(a, b)
+        yield self.waitFor(lambda: self.tips()[0] == self.tips()[1])
+        self.assertEqual(b.ledger.work, a.ledger.work)
+        self.assertEqual(b.ledger.getBalance("CompanyB"), (0, 0))
+        self.assertTrue(b.ledger.isValid(full=True)[1])
+        self.assertEqual(len(b.mempool), 2)  #the losing branch's transactions wait for a block again
+
+    @defer.inlineCallbacks
+    def test_reorganizeDeep(self):
+        #the heavier branch forks more than one header batch back and its first batch alone does not win
+        self.patch(blockchain, "SYNC_BATCH", 5)
+        a, b = self.node(), self.node()
+        self.mine(a, 7, "CompanyA")
+        self.mine(b, 6, "CompanyB")
+        self.link(a, b)
+        yield self.waitFor(lambda: self.tips()[0] == self.tips()[1])
+        self.assertEqual(b.ledger.height, 8)
+        self.assertTrue(b.ledger.isValid(full=True)[1])
+
+    @defer.inlineCallbacks
+    def test_fullBlock(self):
+        a, b = self.node(), self.node()
+        transactions=[Transaction("Sales", float(i+1), "CompanyA", "Supplier") for i in range(500)]
+        block=Block.fromTransactions(1, timestamp_now(), transactions)
+        a.ledger.addNewBlock(block)
+        a.blockAdded(block)
+        self.link(a, b)
+        yield self.waitFor(lambda: b.ledger.height == a.ledger.height)
+        self.assertEqual(len(b.ledger.getLastBlock().transactions), 500)
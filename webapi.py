@@ -0,0 +1,121 @@
+import json
+import time
+import binascii
+from collections import OrderedDict
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web import http
+
+
+CACHE_SIZE=1024 # rendered responses kept, keyed by tip hash and request
+MAX_RANGE=100 # blocks returned by one range request
+
+
+class LRUCache():
+    #least recently used entries are dropped first once `size` entries are held
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size=size
+        self.entries=OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        value=self.entries.pop(key)
+        self.entries[key]=value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key]=value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class NotFound(Exception):
+    pass
+
+
+def block_json(height, block):
+    return {"height": height, "hash": binascii.hexlify(block.hash), "prevhash": binascii.hexlify(block.prevhash),
+            "timestamp": block.timestamp, "nonce": block.nonce, "target": binascii.hexlify(block.target),
+            "transactions": [{"type": tx.block_type, "amount": tx.amount, "to": tx.to_address, "from": tx.from_address}
+                             for tx in block.transactions]}
+
+
+class ApiResource(Resource):
+    #read-only JSON views of the node's ledger under /tip, /blocks, /balance/<address> and /transactions
+    #a response is rendered once per tip: the cache key starts with the tip hash, so appending a block or
+    #a reorganization retires every entry at once, and the tip hash doubles as the ETag for conditional polls
+    isLeaf=True
+
+    def __init__(self, node, cacheSize=CACHE_SIZE):
+        Resource.__init__(self)
+        self.node=node
+        self.ledger=node.ledger
+        self.cache=LRUCache(cacheSize)
+
+    def render_GET(self, request):
+        started=time.time()
+        tiphash=self.ledger.getLastBlock().hash
+        request.setHeader("Content-Type", "application/json")
+        if request.setETag(binascii.hexlify(tiphash)) == http.CACHED:
+            body=""
+        else:
+            key=(tiphash, tuple(request.postpath), tuple((name, tuple(values)) for name, values in sorted(request.args.items())))
+            cached=self.cache.get(key)
+            if cached is None:
+                cached=self.renderJSON(key[1], request.args)
+                self.cache.put(key, cached)
+            status, body = cached
+            request.setResponseCode(status)
+        self.node.metrics.record("http", time.time()-started)
+        self.node.metrics.sent("http", len(body))
+        return body
+
+    def renderJSON(self, path, args):
+        name=path[0] if path and path[0] else "tip"
+        if not hasattr(self, "json_"+name):
+            return http.NOT_FOUND, json.dumps({"error": "unknown resource %s" % name})
+        try:
+            return http.OK, json.dumps(getattr(self, "json_"+name)(path[1:], args))
+        except NotFound as e:
+            return http.NOT_FOUND, json.dumps({"error": str(e)})
+        except (ValueError, IndexError):
+            return http.BAD_REQUEST, json.dumps({"error": "bad request"})
+
+    def json_tip(self, path, args):
+        tip=self.ledger.getLastBlock()
+        return {"height": self.ledger.height, "hash": binascii.hexlify(tip.hash), "work": '%x' % self.ledger.work,
+                "target": binascii.hexlify(tip.target)}
+
+    def json_blocks(self, path, args):
+        #/blocks/<height or hash> for one block, /blocks?start=<height>&count=<n> for a range
+        if path:
+            height=self.ledger.findBlock(path[0])
+            if height is None:
+                raise NotFound("no block %s" % path[0])
+            return block_json(height, self.ledger.chain[height])
+        start=max(int(args.get("start", [0])[0]), 0)
+        end=min(start+min(int(args.get("count", [MAX_RANGE])[0]), MAX_RANGE), self.ledger.height)
+        return {"start": start, "blocks": [block_json(height, self.ledger.chain[height]) for height in range(start, end)]}
+
+    def json_balance(self, path, args):
+        incoming, outgoing = self.ledger.getBalance(path[0])
+        return {"address": path[0], "incoming": incoming, "outgoing": outgoing, "balance": incoming+outgoing}  #outgoing is stored negative
+
+    def json_transactions(self, path, args):
+        index=self.ledger.getIndex()
+        balances=[]
+        for addr in index.addresses:
+            incoming, outgoing = index.balance(addr)
+            balances.append({"address": addr, "incoming": incoming, "outgoing": outgoing})
+        return {"addresses": balances, "types": index.types}
+
+
+class ApiSite(Site):
+    #requests are counted in the node's metrics rather than written to the access log one by one
+    noisy=False
+
+    def log(self, request):
+        pass